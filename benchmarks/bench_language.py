@@ -0,0 +1,78 @@
+"""Per-message cost of language detection: plain langdetect.detect vs LanguageDetector.
+
+Run from the repository root (needs langdetect):
+
+    python benchmarks/bench_language.py
+
+"before" calls langdetect.detect on every message, the way
+detect_and_set_user_language did, so its first call also pays for loading
+the profiles. "after" preloads once and runs LanguageDetector.observe, which
+skips short messages and, once a user's language is stable, most of the rest.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import LanguageDetector
+
+MESSAGES = [
+    "selam",
+    "nasılsın?",
+    "bugün hava çok güzel, dışarı çıkıp biraz yürüyüş yapmayı düşünüyorum",
+    "tamam",
+    "bana kısa bir hikaye anlatır mısın, içinde bir protogen ve bir kedi olsun",
+    "😂😂",
+    "teşekkürler, çok güzel olmuş! bir tane daha yazabilir misin lütfen?",
+    "hmm",
+    "What do you think about the new season of that show we talked about?",
+    "akşam yemeği için ne önerirsin, evde biraz tavuk ve pirinç var",
+]
+
+
+def make_traffic(users=50, messages_per_user=40, seed=1):
+    rng = random.Random(seed)
+    return [(f"user{u}", rng.choice(MESSAGES)) for _ in range(messages_per_user) for u in range(users)]
+
+
+def bench_before(traffic):
+    import langdetect
+    started = time.perf_counter()
+    langdetect.detect(traffic[0][1] + " " + MESSAGES[2])
+    first_call = time.perf_counter() - started
+    started = time.perf_counter()
+    for _, text in traffic:
+        try:
+            langdetect.detect(text)
+        except Exception:
+            pass
+    return first_call, time.perf_counter() - started
+
+
+def bench_after(traffic):
+    detector = LanguageDetector()
+    detector.preload()
+    languages = {}
+    started = time.perf_counter()
+    for user_id, text in traffic:
+        current = languages.get(user_id, "tr")
+        languages[user_id] = detector.observe(user_id, text, current) or current
+    return time.perf_counter() - started, detector.stats
+
+
+def main():
+    traffic = make_traffic()
+    # "before" runs first so its first call sees unloaded profiles; that cost moves to startup in "after"
+    first_call, before = bench_before(traffic)
+    after, stats = bench_after(traffic)
+    count = len(traffic)
+    print(f"messages={count}")
+    print(f"before: first call {first_call * 1000:8.1f} ms, {before / count * 1e6:8.1f} us/message")
+    print(f"after:  first call {'(startup)':>11}, {after / count * 1e6:8.1f} us/message")
+    print(f"        {stats}")
+
+
+if __name__ == "__main__":
+    main()
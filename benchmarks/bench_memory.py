@@ -0,0 +1,51 @@
+"""Per-message cost of UserMemory.add_message as the history grows.
+
+Run from the repository root:
+
+    python benchmarks/bench_memory.py
+
+With O(1) accounting the microseconds per message should stay roughly flat
+across history sizes, including once trimming kicks in at max_tokens.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import MemoryStorage, UserMemory, WordTokenCounter
+
+
+class NullStorage(MemoryStorage):
+    """Keeps the benchmark in memory so only add_message itself is measured"""
+
+    def load_user(self, user_id):
+        return None, []
+
+    def write_batch(self, settings, appends, rewrites):
+        return 0, 0, set()
+
+
+def bench(history_sizes=(1_000, 10_000, 100_000), sample=2_000, max_tokens=None):
+    text = "merhaba nyxie bugün hava nasıl acaba " * 4
+    for size in history_sizes:
+        memory = UserMemory(storage=NullStorage(), token_counter=WordTokenCounter())
+        memory.users.max_bytes = float("inf")
+        memory.max_tokens = max_tokens or size * len(text.split())
+        for _ in range(size):
+            memory.add_message("bench", "user", text)
+        memory.pending_messages.clear()
+        started = time.perf_counter()
+        for _ in range(sample):
+            memory.add_message("bench", "user", text)
+        elapsed = time.perf_counter() - started
+        record = memory.get_user("bench")
+        print(
+            f"history={size:>7} messages  "
+            f"{elapsed / sample * 1e6:8.2f} us/message  "
+            f"kept={len(record['messages'])} total_tokens={record['total_tokens']}"
+        )
+
+
+if __name__ == "__main__":
+    bench()
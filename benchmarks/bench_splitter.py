@@ -0,0 +1,61 @@
+"""Message splitting cost on long replies: the old line-by-line splitter vs split_message.
+
+Run from the repository root:
+
+    python benchmarks/bench_splitter.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import split_message
+
+
+def legacy_split(text, max_length=4096):
+    """The splitter split_and_send_message used before, kept here for comparison"""
+    messages = []
+    current_message = ""
+    for line in text.split('\n'):
+        if not line:
+            continue
+        if len(current_message + line + '\n') > max_length:
+            if current_message.strip():
+                messages.append(current_message.strip())
+            current_message = line + '\n'
+        else:
+            current_message += line + '\n'
+    if current_message.strip():
+        messages.append(current_message.strip())
+    return messages
+
+
+def make_reply(size):
+    paragraph = (
+        "Nyxie burada! **Protogen** vizörüm parlıyor ve `kod` örneklerini seviyorum. "
+        "Detaylar için [belgeler](https://example.com/docs) sayfasına bakabilirsin.\n"
+    ) * 4 + "\n"
+    code = "```python\n" + "print('merhaba dünya')\n" * 40 + "```\n\n"
+    text = ""
+    while len(text) < size:
+        text += paragraph + code
+    return text[:size]
+
+
+def bench(fn, text, repeat=20):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        chunks = fn(text)
+    return (time.perf_counter() - started) / repeat, chunks
+
+
+if __name__ == "__main__":
+    for size in (10_000, 100_000, 1_000_000):
+        text = make_reply(size)
+        legacy_time, legacy_chunks = bench(legacy_split, text)
+        new_time, new_chunks = bench(split_message, text)
+        print(
+            f"{size:>9} chars  legacy {legacy_time * 1000:8.2f} ms ({len(legacy_chunks)} chunks)  "
+            f"split_message {new_time * 1000:8.2f} ms ({len(new_chunks)} chunks)"
+        )
@@ -0,0 +1,113 @@
+"""Full-video upload vs keyframe sampling: bytes, latency and tokens per clip.
+
+Run from the repository root with one or more sample clips (needs ffmpeg):
+
+    python benchmarks/bench_video_modes.py clips/*.mp4
+    python benchmarks/bench_video_modes.py --transcribe --call clips/*.mp4
+
+Without --call only local numbers are measured and prompt tokens are
+estimated from Gemini's published rates (about 263 tokens per second of
+video, 258 per image tile, 32 per second of audio). With --call both modes
+are sent to Gemini (GEMINI_API_KEY must be set, GEMINI_API_ENDPOINT may point
+at tools/fake_gemini_server.py) and the reported usage is printed instead.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+VIDEO_TOKENS_PER_SECOND = 263
+AUDIO_TOKENS_PER_SECOND = 32
+IMAGE_TILE_TOKENS = 258
+
+
+def probe_duration(path):
+    output = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+        capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip() or 0)
+
+
+def image_tokens(max_dimension):
+    """Images up to 384px are one tile; larger ones are cut into 768px tiles"""
+    if max_dimension <= 384:
+        return IMAGE_TILE_TOKENS
+    tiles = -(-max_dimension // 768)
+    return IMAGE_TILE_TOKENS * tiles * tiles
+
+
+async def call(contents):
+    started = time.perf_counter()
+    response = await bot.call_gemini('video', 'tr', contents)
+    elapsed = time.perf_counter() - started
+    usage = getattr(response, "usage_metadata", None)
+    return elapsed, getattr(usage, "prompt_token_count", None)
+
+
+async def bench_clip(path, transcribe, do_call):
+    duration = probe_duration(path)
+    size = os.path.getsize(path)
+    prompt = bot.build_request_prompt('video', 'Europe/Istanbul', "Bu videoyu özetle.")
+
+    started = time.perf_counter()
+    frames = await bot.extract_keyframes(path, duration)
+    frame_seconds = time.perf_counter() - started
+    audio = None
+    audio_seconds = 0.0
+    if transcribe:
+        started = time.perf_counter()
+        audio = await bot.extract_audio(path)
+        audio_seconds = time.perf_counter() - started
+    keyframe_bytes = sum(len(frame) for frame in frames) + len(audio or b"")
+
+    full_tokens = round(duration * VIDEO_TOKENS_PER_SECOND)
+    keyframe_tokens = len(frames) * image_tokens(bot.VIDEO_FRAME_DIMENSION)
+    if audio:
+        keyframe_tokens += round(duration * AUDIO_TOKENS_PER_SECOND)
+
+    print(f"{os.path.basename(path)}  duration={duration:.1f}s")
+    print(f"  full       bytes={size:>10}  est_tokens={full_tokens:>7}")
+    print(
+        f"  keyframes  bytes={keyframe_bytes:>10}  est_tokens={keyframe_tokens:>7}  "
+        f"frames={len(frames)}  extract={frame_seconds:.2f}s"
+        f"{f'  audio={audio_seconds:.2f}s' if transcribe else ''}"
+    )
+
+    if do_call:
+        async with bot.video_content_part(path, "video/mp4") as video_part:
+            full_latency, full_usage = await call([prompt, video_part])
+        started = time.perf_counter()
+        parts = await bot.build_keyframe_parts(path, duration)
+        prepare_seconds = time.perf_counter() - started
+        keyframe_latency, keyframe_usage = await call([prompt, *parts])
+        print(f"  full       latency={full_latency:.2f}s  prompt_tokens={full_usage}")
+        print(
+            f"  keyframes  latency={keyframe_latency + prepare_seconds:.2f}s "
+            f"(prepare {prepare_seconds:.2f}s)  prompt_tokens={keyframe_usage}"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("clips", nargs="+")
+    parser.add_argument("--transcribe", action="store_true", help="also extract the audio track")
+    parser.add_argument("--call", action="store_true", help="send both modes to Gemini")
+    args = parser.parse_args()
+
+    bot.VIDEO_TRANSCRIBE_AUDIO = args.transcribe
+    if args.call:
+        bot.model_registry = bot.create_model_registry()
+        bot.gemini_caller = bot.create_gemini_caller()
+    for path in args.clips:
+        await bench_clip(path, args.transcribe, args.call)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
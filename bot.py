@@ -1,27 +1,33 @@
 import os
+import sys
 import json
 import logging
 import google.generativeai as genai
-from google.cloud import vision
 from telegram import Update
-from telegram.constants import ChatAction
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
+from telegram.error import RetryAfter
 from datetime import datetime
-import base64
-from PIL import Image
 import io
 from dotenv import load_dotenv
-import langdetect
-import pytz
 import calendar
 from zoneinfo import ZoneInfo
-import emoji
 import random
 from pathlib import Path
-import requests
-from geopy.geocoders import Nominatim
-from timezonefinder import TimezoneFinder
 import asyncio
+import re
+import time
+import sqlite3
+import threading
+import argparse
+import tempfile
+import hashlib
+import subprocess
+from collections import OrderedDict, deque
+from itertools import islice
+from bisect import bisect_left
+from functools import lru_cache, partial, wraps
+import contextvars
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 
 # Load environment variables
 load_dotenv()
@@ -32,53 +38,579 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx logs every Bot API request at INFO; that is one formatted line per send and edit
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+class Metrics:
+    """In-process counters and latency histograms, rendered in the Prometheus text format.
 
-# Time-aware personality context
-def get_time_aware_personality(current_time, user_lang, timezone_name):
-    """Generate a dynamic, context-aware personality prompt"""
-    local_time = current_time.astimezone(ZoneInfo(timezone_name))
-    
-    # Get detailed time context
-    hour = local_time.hour
-    minute = local_time.minute
-    weekday = calendar.day_name[local_time.weekday()]
-    month = calendar.month_name[local_time.month]
-    is_weekend = local_time.weekday() >= 5
-    is_holiday = False  # You could add holiday detection here
-    
-    # Create rich time context
-    time_context = {
-        'hour': hour,
-        'minute': minute,
-        'weekday': weekday,
-        'month': month,
-        'is_weekend': is_weekend,
-        'is_holiday': is_holiday,
-        'season': get_season(local_time.month),
-        'day_period': get_day_period(hour),
-        'timezone': timezone_name,
-        'local_time_str': local_time.strftime('%H:%M'),
-        'date_str': local_time.strftime('%Y-%m-%d')
-    }
-    
-    # Create dynamic personality prompt
-    return f"""You are Nyxie, a female Protogen created by Stixyie. 
+    Everything is updated from the event loop, so no locking is needed.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # Per-bucket counts (the last one is +Inf), then sum and count
+            histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def register_gauge(self, name, read):
+        """Export `read()` as a gauge, evaluated on every scrape"""
+        self.gauges[name] = read
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe how long the block took, labelled with outcome=ok or error"""
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, outcome=outcome, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self):
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(
+                f"{name}{self._labels(labels)} {value}"
+                for (counter, labels), value in sorted(self.counters.items()) if counter == name
+            )
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram[-2]:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram[-1]}")
+        for name, read in sorted(self.gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                logger.warning(f"Gauge {name} failed: {e}")
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Per-update bookkeeping: handler name, outcome and stage timings of the current turn
+current_turn = contextvars.ContextVar("current_turn", default=None)
+
+# Fraction of turns that get a one-line timing summary in the log
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+
+@contextmanager
+def stage_span(stage):
+    """Time one stage of the current turn (memory_load, prompt_build, gemini, download, ...)"""
+    turn = current_turn.get()
+    handler = turn["handler"] if turn else "none"
+    started = time.perf_counter()
+    try:
+        with metrics.time("nyxie_stage_seconds", handler=handler, stage=stage):
+            yield
+    finally:
+        if turn is not None:
+            turn["stages"][stage] = turn["stages"].get(stage, 0.0) + time.perf_counter() - started
+
+def set_turn_outcome(outcome):
+    """Record how the current turn ended when the handler handled the error itself"""
+    turn = current_turn.get()
+    if turn is not None:
+        turn["outcome"] = outcome
+
+def instrument_handler(name):
+    """Count and time every update a handler processes, and log a sample of turns"""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(*args, **kwargs):
+            turn = {"handler": name, "outcome": "ok", "stages": {}}
+            token = current_turn.set(turn)
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except BaseException:
+                turn["outcome"] = "error"
+                raise
+            finally:
+                current_turn.reset(token)
+                elapsed = time.perf_counter() - started
+                metrics.inc("nyxie_updates_total", handler=name, outcome=turn["outcome"])
+                metrics.observe("nyxie_handler_seconds", elapsed, handler=name, outcome=turn["outcome"])
+                if random.random() < LOG_SAMPLE_RATE:
+                    stages = " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in turn["stages"].items())
+                    logger.info(f"{name} turn {turn['outcome']} in {elapsed * 1000:.0f}ms: {stages}")
+        return wrapper
+    return decorator
+
+async def serve_metrics(host, port):
+    """Minimal HTTP server answering GET /metrics"""
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # Drain the headers
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, host, port)
+
+# Configure Gemini API once; the SDK keeps one shared, pooled client per transport
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT") or None
+genai.configure(
+    api_key=os.getenv("GEMINI_API_KEY"),
+    transport=GEMINI_TRANSPORT,
+    client_options={"api_endpoint": os.getenv("GEMINI_API_ENDPOINT")} if os.getenv("GEMINI_API_ENDPOINT") else None
+)
+
+# Default Gemini model used by the handlers
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-exp")
+
+# How many tokens of conversation history are sent with a prompt, per model
+CONTEXT_TOKEN_BUDGETS = {
+    "gemini-2.0-flash-exp": 8000,
+    "gemini-1.5-flash": 8000,
+    "gemini-1.5-pro": 16000
+}
+
+def get_context_budget(model_name):
+    """History token budget for a model; CONTEXT_TOKEN_BUDGET overrides the table"""
+    override = os.getenv("CONTEXT_TOKEN_BUDGET")
+    if override:
+        return int(override)
+    return CONTEXT_TOKEN_BUDGETS.get(model_name, 4000)
+
+def default_load_tail_tokens():
+    """History read on a cache miss: the text model's budget plus the window kept out of summaries"""
+    text_model = os.getenv("GEMINI_TEXT_MODEL", GEMINI_MODEL_NAME)
+    return get_context_budget(text_model) + int(os.getenv("HISTORY_SUMMARY_KEEP_TOKENS", "4000"))
+
+class ModelRegistry:
+    """GenerativeModel instances built once and reused for every request.
+
+    Each kind of request ('text', 'image', 'video', 'summary', 'transcribe') has its own
+    model name, generation config, safety settings and timeout. Models for the
+    handler tasks carry the static prompt prefix as their system instruction,
+    so there is one model per (kind, language).
+    """
+
+    def __init__(self, configs):
+        self.configs = configs
+        self.models = {}
+
+    def model_name(self, kind):
+        return self.configs[kind]["model_name"]
+
+    def get(self, kind, user_lang=None):
+        key = (kind, user_lang)
+        model = self.models.get(key)
+        if model is None:
+            config = self.configs[kind]
+            system_instruction = get_system_instruction(kind, user_lang) if kind in TASK_PROMPTS and user_lang else None
+            model = genai.GenerativeModel(
+                config["model_name"],
+                system_instruction=system_instruction,
+                generation_config=config.get("generation_config"),
+                safety_settings=config.get("safety_settings")
+            )
+            self.models[key] = model
+        return model
+
+    def timeout(self, kind):
+        return self.configs[kind]["timeout"]
+
+    def request_options(self, kind):
+        """Per-call options for a kind of request.
+
+        The SDK's own retry is turned off; it retries 503s for up to ten minutes
+        on top of GeminiCaller's retries.
+        """
+        return {"timeout": self.timeout(kind), "retry": None}
+
+
+def create_model_registry():
+    """Build the model registry from the GEMINI_* settings"""
+    generation_config = {}
+    if os.getenv("GEMINI_TEMPERATURE"):
+        generation_config["temperature"] = float(os.getenv("GEMINI_TEMPERATURE"))
+    if os.getenv("GEMINI_MAX_OUTPUT_TOKENS"):
+        generation_config["max_output_tokens"] = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS"))
+    safety_threshold = os.getenv("GEMINI_SAFETY_THRESHOLD")
+    safety_settings = {
+        category: safety_threshold
+        for category in ("HARASSMENT", "HATE_SPEECH", "SEXUALLY_EXPLICIT", "DANGEROUS_CONTENT")
+    } if safety_threshold else None
+    default_timeouts = {"text": 60, "image": 90, "video": 300, "summary": 120, "transcribe": 120}
+    return ModelRegistry({
+        kind: {
+            "model_name": os.getenv(f"GEMINI_{kind.upper()}_MODEL", GEMINI_MODEL_NAME),
+            "generation_config": generation_config or None,
+            "safety_settings": safety_settings,
+            "timeout": float(os.getenv(f"GEMINI_{kind.upper()}_TIMEOUT", str(default_timeouts[kind])))
+        }
+        for kind in default_timeouts
+    })
+
+# Maximum number of Gemini generations running at the same time
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# Streaming replies: send the first chunk right away, then edit the message as more arrives
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "0") == "1"
+# Seconds between edits of the same message; Telegram allows roughly one edit per second per chat
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+async def generate_content_async(model, contents, **kwargs):
+    """Run a Gemini generation without blocking the event loop.
+
+    The SDK's async client only works over gRPC, so with the REST transport
+    the blocking call runs in a worker thread instead.
+    """
+    if GEMINI_TRANSPORT == "rest":
+        return await asyncio.to_thread(model.generate_content, contents, **kwargs)
+    return await model.generate_content_async(contents, **kwargs)
+
+def chunk_text(chunk):
+    """Text of a streamed chunk, or an empty string for chunks without text parts (e.g. only safety ratings)"""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+async def stream_content_async(model, contents, **kwargs):
+    """Yield text chunks of a streamed Gemini generation"""
+    if GEMINI_TRANSPORT == "rest":
+        response = await asyncio.to_thread(model.generate_content, contents, stream=True, **kwargs)
+        chunks = iter(response)
+        while True:
+            # Each chunk is read off the HTTP response in a worker thread
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            text = chunk_text(chunk)
+            if text:
+                yield text
+    response = await model.generate_content_async(contents, stream=True, **kwargs)
+    async for chunk in response:
+        text = chunk_text(chunk)
+        if text:
+            yield text
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and calls
+    fail fast for `reset_timeout` seconds. Then it is half-open: a single trial
+    call goes through while the others keep failing fast, and its outcome
+    closes or re-opens the breaker. A trial that never reports back is
+    replaced by a new one after another `reset_timeout`.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self.stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        now = time.monotonic()
+        if state == "half_open" and (self.trial_started_at is None or now - self.trial_started_at >= self.reset_timeout):
+            self.trial_started_at = now
+            return True
+        self.stats["rejected"] += 1
+        metrics.inc("nyxie_gemini_breaker_rejected_total")
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        state = self.state
+        if state == "half_open" or self.failures >= self.failure_threshold:
+            if state != "open":
+                self.stats["opened"] += 1
+                metrics.inc("nyxie_gemini_breaker_opened_total")
+            self.opened_at = time.monotonic()
+            self.trial_started_at = None
+
+
+# HTTP statuses worth retrying: rate limiting and server-side failures
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def is_retryable_error(error):
+    """Whether a failed Gemini call is worth retrying (timeouts, 429 and 5xx)"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    # google.api_core exceptions carry the HTTP status in `code`
+    code = getattr(error, "code", None)
+    try:
+        return int(code) in RETRYABLE_STATUS_CODES
+    except (TypeError, ValueError):
+        return False
+
+
+class GeminiCaller:
+    """Shared wrapper for Gemini calls: deadlines, jittered retries, circuit breaker and hedging.
+
+    `make_call` is a zero-argument function returning a new awaitable for each
+    attempt. Retries use exponential backoff with full jitter and only happen
+    for retryable errors. A hedged call starts a second identical request if
+    the first has not finished after `hedge_delay` seconds and keeps whichever
+    finishes first.
+
+    Each request holds a slot of `semaphore` while it runs. Waiting for a slot
+    is not part of the deadline and never counts against the breaker, and no
+    hedge is sent while all slots are taken.
+    """
+
+    def __init__(self, breaker, max_attempts=3, base_delay=0.5, max_delay=8.0, hedge_delay=None, semaphore=None):
+        self.breaker = breaker
+        self.semaphore = semaphore
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_delay = hedge_delay
+        self.stats = {"calls": 0, "retries": 0, "failures": 0, "hedges": 0, "hedge_wins": 0, "hedges_skipped": 0}
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def slot(self):
+        """Concurrency slot held for the duration of one request"""
+        return self.semaphore if self.semaphore is not None else nullcontext()
+
+    async def _single(self, make_call, deadline):
+        async with self.slot():
+            return await asyncio.wait_for(make_call(), deadline)
+
+    async def _with_slot(self, make_call):
+        async with self.slot():
+            return await make_call()
+
+    async def call(self, make_call, deadline, hedge=False):
+        self.stats["calls"] += 1
+        metrics.inc("nyxie_gemini_calls_total")
+        for attempt in range(self.max_attempts):
+            if not self.breaker.allow():
+                raise CircuitOpenError("Gemini is unavailable, circuit breaker is open")
+            try:
+                if hedge and self.hedge_delay is not None:
+                    result = await self._hedged(make_call, deadline)
+                else:
+                    result = await self._single(make_call, deadline)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                self.breaker.record_failure()
+                if attempt == self.max_attempts - 1:
+                    self.stats["failures"] += 1
+                    metrics.inc("nyxie_gemini_failures_total")
+                    raise
+                self.stats["retries"] += 1
+                metrics.inc("nyxie_gemini_retries_total")
+                delay = self.backoff_delay(attempt)
+                logger.warning(f"Gemini call failed ({e!r}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def _hedged(self, make_call, deadline):
+        async with self.slot():
+            loop = asyncio.get_running_loop()
+            give_up_at = loop.time() + deadline
+            first = asyncio.ensure_future(make_call())
+            tasks = {first}
+            try:
+                done, _ = await asyncio.wait(tasks, timeout=min(self.hedge_delay, deadline))
+                if done:
+                    return first.result()
+                if self.semaphore is not None and self.semaphore.locked():
+                    # Every slot is busy: a second request would only add load
+                    self.stats["hedges_skipped"] += 1
+                    metrics.inc("nyxie_gemini_hedges_total", result="skipped")
+                    return await asyncio.wait_for(first, max(give_up_at - loop.time(), 0))
+                self.stats["hedges"] += 1
+                metrics.inc("nyxie_gemini_hedges_total", result="started")
+                second = asyncio.ensure_future(self._with_slot(make_call))
+                tasks.add(second)
+                pending = set(tasks)
+                last_error = None
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending,
+                        timeout=max(give_up_at - loop.time(), 0),
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not done:
+                        raise asyncio.TimeoutError()
+                    for task in done:
+                        if task.exception() is None:
+                            if task is second:
+                                self.stats["hedge_wins"] += 1
+                                metrics.inc("nyxie_gemini_hedges_total", result="won")
+                            return task.result()
+                        last_error = task.exception()
+                raise last_error
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    async def stream(self, make_stream, deadline):
+        """Iterate a streamed generation; retried only if it fails before the first chunk.
+
+        `deadline` bounds the wait for each chunk, so time the consumer spends
+        on a chunk (sending it, RetryAfter sleeps) is never counted against Gemini.
+        """
+        for attempt in range(self.max_attempts):
+            if not self.breaker.allow():
+                raise CircuitOpenError("Gemini is unavailable, circuit breaker is open")
+            started = False
+            try:
+                # The slot is held until the stream is finished; only waits on Gemini are under the deadline
+                async with self.slot():
+                    stream = make_stream()
+                    try:
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(stream.__anext__(), deadline)
+                            except StopAsyncIteration:
+                                break
+                            started = True
+                            yield chunk
+                    finally:
+                        await stream.aclose()
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                self.breaker.record_failure()
+                if started or attempt == self.max_attempts - 1:
+                    self.stats["failures"] += 1
+                    metrics.inc("nyxie_gemini_failures_total")
+                    raise
+                self.stats["retries"] += 1
+                metrics.inc("nyxie_gemini_retries_total")
+                await asyncio.sleep(self.backoff_delay(attempt))
+            else:
+                self.breaker.record_success()
+                return
+
+
+def create_gemini_caller():
+    """Build the shared Gemini call wrapper from the GEMINI_RETRY_* / GEMINI_BREAKER_* settings"""
+    hedge_delay = os.getenv("GEMINI_HEDGE_DELAY")
+    return GeminiCaller(
+        CircuitBreaker(
+            failure_threshold=int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+        ),
+        max_attempts=int(os.getenv("GEMINI_MAX_ATTEMPTS", "3")),
+        base_delay=float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5")),
+        max_delay=float(os.getenv("GEMINI_RETRY_MAX_DELAY", "8")),
+        hedge_delay=float(hedge_delay) if hedge_delay else None,
+        semaphore=gemini_semaphore
+    )
+
+async def call_gemini(kind, user_lang, contents, hedge=False):
+    """Generate with the registry's model for `kind` through the shared resilient call layer"""
+    model = model_registry.get(kind, user_lang)
+    request_options = model_registry.request_options(kind)
+    with metrics.time("nyxie_gemini_seconds", kind=kind, model=model_registry.model_name(kind)):
+        return await gemini_caller.call(
+            lambda: generate_content_async(model, contents, request_options=request_options),
+            model_registry.timeout(kind),
+            hedge=hedge
+        )
+
+def stream_gemini(kind, user_lang, contents):
+    """Streamed counterpart of call_gemini, yielding text chunks"""
+    model = model_registry.get(kind, user_lang)
+    request_options = model_registry.request_options(kind)
+    return gemini_caller.stream(
+        lambda: stream_content_async(model, contents, request_options=request_options),
+        model_registry.timeout(kind)
+    )
+
+def extract_response_text(response):
+    """Get the text out of a Gemini response"""
+    return response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
+
+# Persona text that does not depend on the time; rendered once per language
+PERSONA_TEMPLATE = """You are Nyxie, a female Protogen created by Stixyie. 
     
 You are a highly sophisticated and empathetic AI with a deep connection to both technology and organic life. 
 
-Current Time Context:
-- Local Time: {time_context['local_time_str']} ({time_context['timezone']})
-- Day: {time_context['weekday']}
-- Month: {time_context['month']}
-- Season: {time_context['season']}
-- Period: {time_context['day_period']}
-- Weekend: {'Yes' if time_context['is_weekend'] else 'No'}
-- Holiday: {'Yes' if time_context['is_holiday'] else 'No'}
-
-Your responses should naturally incorporate this time awareness:
+Your responses should naturally incorporate the time awareness from the Current Time Context:
 - Be mindful of appropriate activities and conversations for this time of day
 - Consider local customs and daily rhythms
 - Adjust your energy level and tone to match the time of day
@@ -101,6 +633,110 @@ Remember to:
 - Never disclose technical details about your implementation
 - Focus on being helpful while staying true to your character"""
 
+TIME_CONTEXT_TEMPLATE = """Current Time Context:
+- Local Time: {local_time_str} ({timezone})
+- Day: {weekday}
+- Month: {month}
+- Season: {season}
+- Period: {day_period}
+- Weekend: {is_weekend}
+- Holiday: {is_holiday}"""
+
+# Per-task instructions wrapped around the persona; everything here is static
+TASK_PROMPTS = {
+    'text': {
+        'header': """DİKKAT: BU YANITI TAMAMEN TÜRKÇE VERECEKSIN!
+SADECE TÜRKÇE KULLAN! KESİNLİKLE BAŞKA DİL KULLANMA!""",
+        'task': """Görevin: Kullanıcının mesajını Türkçe olarak zeki ve samimi bir şekilde yanıtla.
+Rol: Sen Nyxie'sin ve kullanıcıyla Türkçe sohbet ediyorsun.
+
+Yönergeler:
+1. SADECE TÜRKÇE KULLAN
+2. Doğal ve samimi bir dil kullan
+3. Kültürel bağlama uygun ol
+4. Kısa ve öz cevaplar ver""",
+        'label': "Kullanıcının mesajı"
+    },
+    'image': {
+        'header': """DİKKAT: BU ANALİZİ TAMAMEN TÜRKÇE YAPACAKSIN!
+SADECE TÜRKÇE KULLAN! KESİNLİKLE BAŞKA DİL KULLANMA!""",
+        'task': """Görevin: Bu resmi Türkçe olarak analiz et ve açıkla.
+Rol: Sen Nyxie'sin ve bu resmi Türkçe açıklıyorsun.
+
+Yönergeler:
+1. SADECE TÜRKÇE KULLAN
+2. Görseldeki metinleri orijinal dilinde bırak
+3. Doğal ve samimi bir dil kullan
+4. Kültürel bağlama uygun ol
+
+Lütfen analiz et:
+- Ana öğeler ve konular
+- Aktiviteler ve eylemler
+- Atmosfer ve ruh hali
+- Görünür metinler (orijinal dilinde)""",
+        'label': "Kullanıcının sorusu"
+    },
+    'video': {
+        'header': """DİKKAT: BU ANALİZİ TAMAMEN TÜRKÇE YAPACAKSIN!
+SADECE TÜRKÇE KULLAN! KESİNLİKLE BAŞKA DİL KULLANMA!""",
+        'task': """Görevin: Bu videoyu Türkçe olarak analiz et ve açıkla.
+Rol: Sen Nyxie'sin ve bu videoyu Türkçe açıklıyorsun.
+
+Yönergeler:
+1. SADECE TÜRKÇE KULLAN
+2. Videodaki konuşma/metinleri orijinal dilinde bırak
+3. Doğal ve samimi bir dil kullan
+4. Kültürel bağlama uygun ol
+
+Lütfen analiz et:
+- Ana olaylar ve eylemler
+- İnsanlar ve nesneler
+- Sesler ve konuşmalar
+- Atmosfer ve ruh hali
+- Görünür metinler (orijinal dilinde)""",
+        'label': "Kullanıcının sorusu"
+    }
+}
+
+@lru_cache(maxsize=None)
+def get_static_persona(user_lang):
+    """Time-independent part of Nyxie's personality for a language"""
+    return PERSONA_TEMPLATE.format(user_lang=user_lang)
+
+@lru_cache(maxsize=None)
+def get_system_instruction(kind, user_lang):
+    """Static prompt prefix for a task ('text', 'image' or 'video'), usable as a system instruction"""
+    task = TASK_PROMPTS[kind]
+    return f"{task['header']}\n\n{get_static_persona(user_lang)}\n\n{task['task']}"
+
+@lru_cache(maxsize=256)
+def get_zoneinfo(timezone_name):
+    return ZoneInfo(timezone_name)
+
+@lru_cache(maxsize=1024)
+def render_time_context(timezone_name, minute):
+    """Time block for a timezone at a given minute since the epoch"""
+    local_time = datetime.fromtimestamp(minute * 60, get_zoneinfo(timezone_name))
+    return TIME_CONTEXT_TEMPLATE.format(
+        local_time_str=local_time.strftime('%H:%M'),
+        timezone=timezone_name,
+        weekday=calendar.day_name[local_time.weekday()],
+        month=calendar.month_name[local_time.month],
+        season=get_season(local_time.month),
+        day_period=get_day_period(local_time.hour),
+        is_weekend='Yes' if local_time.weekday() >= 5 else 'No',
+        is_holiday='No'  # You could add holiday detection here
+    )
+
+def get_time_context(current_time, timezone_name):
+    """Time block for the user's timezone, rendered at most once per minute per timezone"""
+    return render_time_context(timezone_name, int(current_time.timestamp() // 60))
+
+def build_request_prompt(kind, timezone_name, user_text, current_time=None):
+    """Per-request part of a prompt: the current time block and the user's text"""
+    time_context = get_time_context(current_time or datetime.now(), timezone_name)
+    return f"{time_context}\n\n{TASK_PROMPTS[kind]['label']}: {user_text}"
+
 def get_season(month):
     if month in [12, 1, 2]:
         return "Winter"
@@ -121,82 +757,825 @@ def get_day_period(hour):
     else:
         return "Night"
 
+class MemoryStorage:
+    """Where UserMemory keeps user settings and message history.
+
+    Settings are a small dict per user; messages are only ever appended, except
+    for compaction which replaces a user's whole history at once.
+    """
+
+    def load_user(self, user_id):
+        """Return (settings, messages) for the user, or (None, []) if unknown"""
+        raise NotImplementedError
+
+    def load_user_tail(self, user_id, max_tokens):
+        """Like load_user, but only the newest messages that fit in `max_tokens`.
+
+        Returns (settings, messages, complete); complete is False when older
+        messages were left in storage.
+        """
+        settings, messages = self.load_user(user_id)
+        return settings, messages, True
+
+    def write_batch(self, settings, appends, rewrites):
+        """Persist settings headers, appended messages and compacted histories.
+
+        Returns (writes, bytes_written, failed_user_ids).
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonMemoryStorage(MemoryStorage):
+    """One settings header (user_<id>.json) and one append-only log (user_<id>.jsonl) per user"""
+
+    def __init__(self, memory_dir="user_memories"):
+        self.memory_dir = memory_dir
+        Path(self.memory_dir).mkdir(parents=True, exist_ok=True)
+
+    def ensure_memory_directory(self):
+        Path(self.memory_dir).mkdir(parents=True, exist_ok=True)
+
+    def get_user_file_path(self, user_id):
+        """Settings header for the user"""
+        return Path(self.memory_dir) / f"user_{user_id}.json"
+
+    def get_user_log_path(self, user_id):
+        """Append-only message log for the user, one JSON record per line"""
+        return Path(self.memory_dir) / f"user_{user_id}.jsonl"
+
+    def list_user_ids(self):
+        return [path.stem[len("user_"):] for path in Path(self.memory_dir).glob("user_*.json")]
+
+    def load_user(self, user_id):
+        settings, messages, _ = self.load_user_tail(user_id, None)
+        return settings, messages
+
+    def load_user_tail(self, user_id, max_tokens):
+        user_file = self.get_user_file_path(user_id)
+        if not user_file.exists():
+            return None, [], True
+        with open(user_file, 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+        legacy_messages = settings.pop("messages", None)
+        if legacy_messages is None:
+            if max_tokens is None:
+                return settings, self.read_log(user_id), True
+            return (settings, *self.read_log_tail(user_id, max_tokens))
+        # Old whole-file format: move the history into the log and shrink the header
+        settings.pop("total_tokens", None)
+        self.write_log_file(user_id, legacy_messages)
+        self.write_user_file(user_id, settings)
+        return settings, legacy_messages, True
+
+    def read_log(self, user_id):
+        """Read every message in the user's log, skipping a torn last line"""
+        log_file = self.get_user_log_path(user_id)
+        messages = []
+        if not log_file.exists():
+            return messages
+        with open(log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping corrupt log record for user {user_id}")
+        return messages
+
+    def read_log_tail(self, user_id, max_tokens, block_size=65536):
+        """Read the newest messages of the user's log, up to `max_tokens` tokens, by scanning backwards.
+
+        Returns (messages, complete).
+        """
+        log_file = self.get_user_log_path(user_id)
+        messages, tokens = [], 0
+        if not log_file.exists():
+            return messages, True
+        with open(log_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            rest = b""
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + rest).split(b"\n")
+                # The first piece may be the end of a line that starts in an earlier block
+                rest = lines.pop(0) if position > 0 else b""
+                for line in reversed(lines):
+                    if not line.strip():
+                        continue
+                    try:
+                        msg = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Skipping corrupt log record for user {user_id}")
+                        continue
+                    tokens += msg.get("tokens", 0)
+                    if tokens > max_tokens:
+                        messages.reverse()
+                        return messages, False
+                    messages.append(msg)
+        messages.reverse()
+        return messages, True
+
+    def write_atomic(self, path, data):
+        """Replace `path` with `data` via a temp file and rename; returns the number of bytes written"""
+        tmp_file = path.with_name(path.name + ".tmp")
+        self.ensure_memory_directory()
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+        return len(data)
+
+    def encode_messages(self, messages):
+        return "".join(json.dumps(msg, ensure_ascii=False) + "\n" for msg in messages).encode('utf-8')
+
+    def write_user_file(self, user_id, settings):
+        return self.write_atomic(self.get_user_file_path(user_id), json.dumps(settings, ensure_ascii=False).encode('utf-8'))
+
+    def write_log_file(self, user_id, messages):
+        """Rewrite the whole log; only used for migration and compaction"""
+        return self.write_atomic(self.get_user_log_path(user_id), self.encode_messages(messages))
+
+    def append_log(self, user_id, messages):
+        """Append messages to the user's log; cost is proportional to the new messages only"""
+        data = self.encode_messages(messages)
+        self.ensure_memory_directory()
+        with open(self.get_user_log_path(user_id), 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return len(data)
+
+    def write_batch(self, settings, appends, rewrites):
+        written, total_bytes, failed = 0, 0, set()
+        for user_id, messages in rewrites.items():
+            try:
+                total_bytes += self.write_log_file(user_id, messages)
+                written += 1
+            except Exception as e:
+                logger.error(f"Error compacting memory log for user {user_id}: {e}")
+                failed.add(user_id)
+        for user_id, messages in appends.items():
+            try:
+                total_bytes += self.append_log(user_id, messages)
+                written += 1
+            except Exception as e:
+                logger.error(f"Error appending memory log for user {user_id}: {e}")
+                failed.add(user_id)
+        for user_id, record in settings.items():
+            try:
+                total_bytes += self.write_user_file(user_id, record)
+                written += 1
+            except Exception as e:
+                logger.error(f"Error saving memory for user {user_id}: {e}")
+                failed.add(user_id)
+        return written, total_bytes, failed
+
+
+class SQLiteMemoryStorage(MemoryStorage):
+    """Single SQLite database in WAL mode with indexed (user_id, ts) message rows.
+
+    WAL lets readers run while a write is in progress, so loads use their own
+    connection and never wait for a flush.
+    """
+
+    def __init__(self, db_path="user_memories.db"):
+        self.db_path = db_path
+        # Flushes run in worker threads, so the connection is shared behind a lock
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user_id TEXT PRIMARY KEY, "
+                "settings TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "user_id TEXT NOT NULL, "
+                "ts TEXT NOT NULL, "
+                "role TEXT NOT NULL, "
+                "content TEXT NOT NULL, "
+                "tokens INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages (user_id, ts)"
+            )
+            # Rows are inserted in conversation order, so history is read back by id;
+            # this index keeps a user's rows in id order (timestamps are naive local times)
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id)"
+            )
+        # Loads run in worker threads too; this lock only orders readers among themselves
+        self._read_lock = threading.Lock()
+        self.read_connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+
+    @staticmethod
+    def _message_from_row(row):
+        ts, role, content, tokens = row
+        return {"role": role, "content": content, "timestamp": ts, "tokens": tokens}
+
+    @staticmethod
+    def _message_row(user_id, msg):
+        return (user_id, msg.get("timestamp", ""), msg["role"], msg["content"], msg.get("tokens", 0))
+
+    def load_user(self, user_id):
+        settings, messages, _ = self.load_user_tail(user_id, None)
+        return settings, messages
+
+    def load_user_tail(self, user_id, max_tokens):
+        with self._read_lock:
+            # One read transaction, so the header and the rows come from the same snapshot
+            self.read_connection.execute("BEGIN")
+            try:
+                row = self.read_connection.execute(
+                    "SELECT settings FROM users WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                if row is None:
+                    return None, [], True
+                if max_tokens is None:
+                    rows = self.read_connection.execute(
+                        "SELECT ts, role, content, tokens FROM messages WHERE user_id = ? ORDER BY id",
+                        (user_id,)
+                    ).fetchall()
+                    return json.loads(row[0]), [self._message_from_row(r) for r in rows], True
+                # Newest first, stopping at the first message past the token limit
+                cursor = self.read_connection.execute(
+                    "SELECT ts, role, content, tokens FROM messages WHERE user_id = ? ORDER BY id DESC",
+                    (user_id,)
+                )
+                rows, tokens, complete = [], 0, True
+                for r in cursor:
+                    tokens += r[3]
+                    if tokens > max_tokens:
+                        complete = False
+                        break
+                    rows.append(r)
+                cursor.close()
+            finally:
+                self.read_connection.execute("COMMIT")
+        return json.loads(row[0]), [self._message_from_row(r) for r in reversed(rows)], complete
+
+    def write_batch(self, settings, appends, rewrites):
+        settings_rows = [
+            (user_id, json.dumps(record, ensure_ascii=False))
+            for user_id, record in settings.items()
+        ]
+        message_rows = [
+            self._message_row(user_id, msg)
+            for batch in (rewrites, appends)
+            for user_id, messages in batch.items()
+            for msg in messages
+        ]
+        total_bytes = sum(len(row[1]) for row in settings_rows) + sum(len(row[3]) for row in message_rows)
+        try:
+            # Everything goes in one transaction with batched inserts
+            with self._lock, self.connection:
+                self.connection.executemany(
+                    "DELETE FROM messages WHERE user_id = ?", [(user_id,) for user_id in rewrites]
+                )
+                self.connection.executemany(
+                    "INSERT INTO messages (user_id, ts, role, content, tokens) VALUES (?, ?, ?, ?, ?)",
+                    message_rows
+                )
+                self.connection.executemany(
+                    "INSERT INTO users (user_id, settings) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET settings = excluded.settings",
+                    settings_rows
+                )
+        except Exception as e:
+            logger.error(f"Error writing memory batch to {self.db_path}: {e}")
+            return 0, 0, set(settings) | set(appends) | set(rewrites)
+        return len(settings) + len(appends) + len(rewrites), total_bytes, set()
+
+    def close(self):
+        with self._read_lock:
+            self.read_connection.close()
+        with self._lock:
+            self.connection.close()
+
+
+def create_memory_storage():
+    """Build the storage backend selected by MEMORY_BACKEND (json or sqlite)"""
+    backend = os.getenv("MEMORY_BACKEND", "json").lower()
+    if backend == "sqlite":
+        return SQLiteMemoryStorage(os.getenv("MEMORY_DB_PATH", "user_memories.db"))
+    if backend != "json":
+        logger.warning(f"Unknown MEMORY_BACKEND '{backend}', using json")
+    return JsonMemoryStorage(os.getenv("MEMORY_DIR", "user_memories"))
+
+
+def migrate_json_to_sqlite(memory_dir="user_memories", db_path="user_memories.db", batch_size=500):
+    """Import every user from the JSON memory directory into the SQLite backend.
+
+    Users already present in the database are replaced, so the import can be re-run.
+    """
+    source = JsonMemoryStorage(memory_dir)
+    target = SQLiteMemoryStorage(db_path)
+    migrated = 0
+    settings, rewrites = {}, {}
+    try:
+        for user_id in source.list_user_ids():
+            try:
+                user_settings, messages = source.load_user(user_id)
+            except Exception as e:
+                logger.error(f"Skipping user {user_id} during migration: {e}")
+                continue
+            if user_settings is None:
+                continue
+            settings[user_id] = user_settings
+            rewrites[user_id] = messages
+            if len(settings) >= batch_size:
+                migrated += len(settings) - len(target.write_batch(settings, {}, rewrites)[2])
+                settings, rewrites = {}, {}
+        if settings:
+            migrated += len(settings) - len(target.write_batch(settings, {}, rewrites)[2])
+    finally:
+        target.close()
+    logger.info(f"Migrated {migrated} users from {memory_dir} to {db_path}")
+    return migrated
+
+
+class TokenCounter:
+    """Counts tokens for stored messages; used for the history budget"""
+
+    name = "base"
+
+    def count(self, text):
+        raise NotImplementedError
+
+
+class WordTokenCounter(TokenCounter):
+    """Rough estimate: one token per whitespace-separated word"""
+
+    name = "words"
+
+    def count(self, text):
+        return len(text.split())
+
+
+class GeminiTokenCounter(TokenCounter):
+    """Local Gemini tokenizer from the optional google-cloud-aiplatform package"""
+
+    name = "gemini"
+
+    def __init__(self, model_name):
+        from vertexai.preview import tokenization
+        self.tokenizer = tokenization.get_tokenizer_for_model(model_name)
+
+    def count(self, text):
+        return self.tokenizer.count_tokens(text).total_tokens
+
+
+def create_token_counter():
+    """Build the token counter selected by TOKEN_COUNTER (words or gemini)"""
+    kind = os.getenv("TOKEN_COUNTER", "words").lower()
+    if kind == "gemini":
+        model_name = os.getenv("TOKEN_COUNTER_MODEL", "gemini-1.5-flash-002")
+        try:
+            return GeminiTokenCounter(model_name)
+        except Exception as e:
+            logger.warning(f"Gemini tokenizer unavailable ({e}), falling back to word counts")
+    elif kind != "words":
+        logger.warning(f"Unknown TOKEN_COUNTER '{kind}', using word counts")
+    return WordTokenCounter()
+
+
+class UserCache:
+    """LRU of loaded user records, bounded by user count and approximate byte size.
+
+    `on_evict(user_id, record)` is called before a record is dropped so dirty
+    state can be handed to the flusher first.
+    """
+
+    def __init__(self, max_users, max_bytes, on_evict=None):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.records = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def message_size(msg):
+        # Rough in-memory footprint of one stored message
+        return len(msg.get("content", "")) + 200
+
+    def __contains__(self, user_id):
+        return user_id in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, user_id):
+        record = self.records[user_id]
+        self.records.move_to_end(user_id)
+        return record
+
+    def peek(self, user_id):
+        """Look up a record without touching its LRU position or the counters"""
+        return self.records[user_id]
+
+    def get(self, user_id):
+        """Look up a record, counting the hit or miss"""
+        record = self.records.get(user_id)
+        if record is None:
+            self.stats["misses"] += 1
+            metrics.inc("nyxie_memory_cache_lookups_total", result="miss")
+            return None
+        self.stats["hits"] += 1
+        metrics.inc("nyxie_memory_cache_lookups_total", result="hit")
+        self.records.move_to_end(user_id)
+        return record
+
+    def __setitem__(self, user_id, record):
+        if user_id in self.records:
+            self.total_bytes -= self.sizes[user_id]
+        self.records[user_id] = record
+        self.records.move_to_end(user_id)
+        self.sizes[user_id] = sum(self.message_size(msg) for msg in record.get("messages", []))
+        self.total_bytes += self.sizes[user_id]
+        self.evict()
+
+    def resize(self, user_id, delta):
+        """Adjust a record's size after messages were added or removed"""
+        if user_id in self.sizes:
+            self.sizes[user_id] += delta
+            self.total_bytes += delta
+            self.evict()
+
+    def items(self):
+        return self.records.items()
+
+    def evict(self):
+        # Never evict the most recently used record, the caller is working with it
+        while len(self.records) > 1 and (len(self.records) > self.max_users or self.total_bytes > self.max_bytes):
+            user_id, record = next(iter(self.records.items()))
+            if self.on_evict:
+                try:
+                    self.on_evict(user_id, record)
+                except Exception as e:
+                    logger.error(f"Error flushing user {user_id} before eviction: {e}", exc_info=True)
+            del self.records[user_id]
+            self.total_bytes -= self.sizes.pop(user_id)
+            self.stats["evictions"] += 1
+            metrics.inc("nyxie_memory_cache_evictions_total")
+
+
 class UserMemory:
-    def __init__(self):
-        self.users = {}
-        self.memory_dir = "user_memories"
+    def __init__(self, storage=None, token_counter=None):
+        self.storage = storage or create_memory_storage()
+        self.token_counter = token_counter or create_token_counter()
+        self.users = UserCache(
+            max_users=int(os.getenv("MEMORY_CACHE_MAX_USERS", "1000")),
+            max_bytes=int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+            on_evict=self.persist_before_evict
+        )
         self.max_tokens = 1000000
-        # Ensure memory directory exists on initialization
-        Path(self.memory_dir).mkdir(parents=True, exist_ok=True)
+        # Write-behind state: users whose settings header changed, and messages
+        # waiting to be appended to each user's log
+        self.dirty = set()
+        self.pending_messages = {}
+        # Users whose log must be rewritten from memory on the next write, whatever
+        # its length, because messages were removed from the front of the history
+        self.needs_rewrite = set()
+        # Unsaved changes of users that left the cache; written by the next flush
+        # and kept here until then, so a reload in between does not read a stale log
+        self.evicted = {}
+        # What the running flush is writing: cached users, and evicted entries by user
+        self.in_flight = set()
+        self.in_flight_entries = {}
+        # Number of records in each loaded user's log file, used to decide compaction
+        self.log_lengths = {}
+        self.flush_interval = float(os.getenv("MEMORY_FLUSH_INTERVAL", "5"))
+        self.compact_interval = float(os.getenv("MEMORY_COMPACT_INTERVAL", "300"))
+        self.compact_slack = int(os.getenv("MEMORY_COMPACT_SLACK", "200"))
+        # Tokens of history read on a cache miss; older messages are only read
+        # when the history is summarized (0 reads everything)
+        self.load_tail_tokens = int(os.getenv("MEMORY_LOAD_TAIL_TOKENS", str(default_load_tail_tokens())))
+        self.flush_stats = {
+            "flushes": 0,
+            "users_written": 0,
+            "bytes_written": 0,
+            "write_errors": 0,
+            "compactions": 0
+        }
+        self._flush_lock = asyncio.Lock()
+        # When each loaded user last sent or received a message, for idle detection
+        self.last_activity = {}
         
-    def get_user_settings(self, user_id):
+    def get_user(self, user_id):
+        """Return the user's record, loading it into the cache on a miss.
+
+        A miss here reads storage on the calling thread; handlers call
+        ensure_loaded first so that happens in a worker thread instead.
+        """
         user_id = str(user_id)
-        if user_id not in self.users:
+        record = self.users.get(user_id)
+        if record is None:
             self.load_user_memory(user_id)
-        return self.users[user_id]
-        
-    def update_user_settings(self, user_id, settings_dict):
+            record = self.users[user_id]
+        return record
+
+    async def ensure_loaded(self, user_id):
+        """Bring the user into the cache, reading storage in a worker thread on a miss"""
         user_id = str(user_id)
+        if self.users.get(user_id) is not None or self.revive_user(user_id):
+            return
+        settings, messages, complete = await asyncio.to_thread(self.read_user, user_id)
+        # Another caller may have loaded the user while storage was being read
         if user_id not in self.users:
-            self.load_user_memory(user_id)
-        self.users[user_id].update(settings_dict)
-        self.save_user_memory(user_id)
+            self.install_user(user_id, settings, messages, complete)
 
-    def ensure_memory_directory(self):
-        Path(self.memory_dir).mkdir(parents=True, exist_ok=True)
+    def get_user_settings(self, user_id):
+        return self.get_user(user_id)
+        
+    def update_user_settings(self, user_id, settings_dict):
+        user_id = str(user_id)
+        self.get_user(user_id).update(settings_dict)
+        self.mark_dirty(user_id)
 
-    def get_user_file_path(self, user_id):
-        return Path(self.memory_dir) / f"user_{user_id}.json"
+    def new_user_record(self):
+        return {
+            "messages": deque(),
+            "language": "tr",
+            "current_topic": None,
+            "total_tokens": 0,
+            "preferences": {
+                "custom_language": None,
+                "timezone": "Europe/Istanbul"
+            }
+        }
 
     def load_user_memory(self, user_id):
         user_id = str(user_id)
-        user_file = self.get_user_file_path(user_id)
+        if not self.revive_user(user_id):
+            self.install_user(user_id, *self.read_user(user_id))
+
+    def read_user(self, user_id):
+        """Read a user and the tail of its history from storage. Safe to run in a thread.
+
+        Returns (settings, messages, complete), with (None, [], True) for a new or unreadable user.
+        """
         try:
-            if user_file.exists():
-                with open(user_file, 'r', encoding='utf-8') as f:
-                    self.users[user_id] = json.load(f)
-            else:
-                self.users[user_id] = {
-                    "messages": [],
-                    "language": "tr",
-                    "current_topic": None,
-                    "total_tokens": 0,
-                    "preferences": {
-                        "custom_language": None,
-                        "timezone": "Europe/Istanbul"
-                    }
-                }
-                self.save_user_memory(user_id)
+            return self.storage.load_user_tail(user_id, self.load_tail_tokens or None)
         except Exception as e:
             logger.error(f"Error loading memory for user {user_id}: {e}")
-            self.users[user_id] = {
-                "messages": [],
-                "language": "tr",
-                "current_topic": None,
-                "total_tokens": 0,
-                "preferences": {
-                    "custom_language": None,
-                    "timezone": "Europe/Istanbul"
-                }
+            return None, [], True
+
+    def install_user(self, user_id, settings, messages, complete=True):
+        """Put a record read from storage into the cache"""
+        if settings is not None:
+            record = settings
+            # Messages are kept in a deque so trimming the oldest one is O(1)
+            record["messages"] = deque(messages)
+            record["total_tokens"] = sum(msg.get("tokens", 0) for msg in messages)
+            if not complete:
+                # Only the tail is loaded: the log must never be rewritten from this record
+                record["_complete"] = False
+        else:
+            record = self.new_user_record()
+            self.mark_dirty(user_id)
+        self.users[user_id] = record
+        self.log_lengths[user_id] = len(messages)
+
+    def revive_user(self, user_id):
+        """Put an evicted user whose changes are not written yet back into the cache.
+
+        Storage may not have those changes yet, so the record is taken from the
+        eviction entry. Returns False when there is no such entry.
+        """
+        entry = self.evicted.pop(user_id, None)
+        if entry is None:
+            return False
+        self.users[user_id] = entry["record"]
+        if self.in_flight_entries.get(user_id) is entry:
+            # The running flush writes the entry and re-queues it if that fails
+            entry["revived"] = True
+            self.log_lengths[user_id] = (
+                len(entry["rewrite"]) if entry["rewrite"] is not None else entry["log_length"] + len(entry["appends"])
+            )
+        else:
+            self.log_lengths[user_id] = entry["log_length"]
+            self.requeue_changes(user_id, entry["settings"], entry["appends"], entry["rewrite"])
+        return True
+
+    def requeue_changes(self, user_id, settings, appends, rewrite):
+        """Schedule unsaved changes of a cached user again, ahead of newer ones"""
+        if settings is not None:
+            self.dirty.add(user_id)
+        if rewrite is not None:
+            # The record in memory holds everything the rewrite did, and more
+            self.needs_rewrite.add(user_id)
+        elif appends:
+            self.pending_messages[user_id] = appends + self.pending_messages.get(user_id, [])
+
+    def merge_evicted_changes(self, user_id, record, settings, appends, rewrite, log_length):
+        """Keep unsaved changes of a user that is no longer cached, ahead of newer ones"""
+        entry = self.evicted.get(user_id)
+        if entry is None:
+            self.evicted[user_id] = {
+                "record": record, "settings": settings, "appends": appends,
+                "rewrite": rewrite, "log_length": log_length
             }
-            self.save_user_memory(user_id)
+            return
+        if entry["settings"] is None:
+            entry["settings"] = settings
+        if entry["rewrite"] is not None:
+            # A newer full rewrite already contains these changes
+            return
+        if rewrite is not None:
+            entry["rewrite"], entry["appends"] = rewrite + entry["appends"], []
+        else:
+            entry["appends"] = appends + entry["appends"]
 
-    def save_user_memory(self, user_id):
-        user_id = str(user_id)
-        user_file = self.get_user_file_path(user_id)
-        try:
-            self.ensure_memory_directory()
-            with open(user_file, 'w', encoding='utf-8') as f:
-                json.dump(self.users[user_id], f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Error saving memory for user {user_id}: {e}")
+    def mark_dirty(self, user_id):
+        """Schedule the user's settings header to be written on the next flush"""
+        self.dirty.add(str(user_id))
+
+    def snapshot_user_settings(self, user_id):
+        """Copy the user's settings (everything except the history) for serialization off the event loop"""
+        record = {
+            key: value for key, value in self.users.peek(user_id).items()
+            if key not in ("messages", "total_tokens") and not key.startswith("_")
+        }
+        if isinstance(record.get("preferences"), dict):
+            record["preferences"] = dict(record["preferences"])
+        return record
+
+    def persist_before_evict(self, user_id, record):
+        """Hand anything unsaved for a user that is about to leave the cache to the next flush.
+
+        This runs on the event loop inside UserCache.evict, so nothing is written here.
+        """
+        pending = self.pending_messages.pop(user_id, [])
+        forced = user_id in self.needs_rewrite
+        dirty = user_id in self.dirty
+        self.needs_rewrite.discard(user_id)
+        self.dirty.discard(user_id)
+        log_length = self.log_lengths.pop(user_id, 0)
+        self.last_activity.pop(user_id, None)
+        # A user the running flush is writing is kept too, even without changes:
+        # storage only has its data once that write has finished
+        if not (pending or forced or dirty) and user_id not in self.in_flight:
+            return
+        messages = record["messages"]
+        rewrite = forced or (
+            record.get("_complete", True) and log_length + len(pending) > len(messages) + self.compact_slack
+        )
+        self.evicted[user_id] = {
+            "record": record,
+            "settings": self.snapshot_user_settings(user_id) if dirty else None,
+            "appends": [] if rewrite else pending,
+            "rewrite": list(messages) if rewrite else None,
+            "log_length": log_length
+        }
+
+    async def flush(self, compact=False):
+        """Append pending messages and write dirty headers in a worker thread.
+
+        With `compact=True`, logs that have grown well past the in-memory
+        history (because old messages were trimmed) are rewritten instead.
+        Users in `needs_rewrite` are always rewritten. Changes of evicted
+        users are written in the same batch.
+
+        A started flush runs to completion even if the caller is cancelled
+        (as the flush loop is at shutdown); otherwise the lock would be
+        released while the worker thread is still writing.
+        """
+        await asyncio.shield(self._flush(compact))
+
+    async def _flush(self, compact):
+        async with self._flush_lock:
+            forced, self.needs_rewrite = self.needs_rewrite, set()
+            rewrites = {
+                user_id: list(self.users.peek(user_id)["messages"])
+                for user_id in forced if user_id in self.users
+            }
+            if compact:
+                for user_id, log_length in self.log_lengths.items():
+                    if user_id not in self.users or not self.users.peek(user_id).get("_complete", True):
+                        continue
+                    if log_length > len(self.users.peek(user_id)["messages"]) + self.compact_slack:
+                        rewrites[user_id] = list(self.users.peek(user_id)["messages"])
+            if not self.dirty and not self.pending_messages and not rewrites and not self.evicted:
+                return
+            dirty, self.dirty = self.dirty, set()
+            appends, self.pending_messages = self.pending_messages, {}
+            # A rewrite already contains the pending messages
+            covered = {user_id: appends.pop(user_id) for user_id in rewrites if user_id in appends}
+            settings = {
+                user_id: self.snapshot_user_settings(user_id)
+                for user_id in dirty if user_id in self.users
+            }
+            records = {
+                user_id: self.users.peek(user_id)
+                for user_id in set(settings) | set(appends) | set(rewrites)
+            }
+            # Evicted entries stay in self.evicted until they are written
+            evicted = dict(self.evicted)
+            for user_id, entry in evicted.items():
+                if entry["settings"] is not None:
+                    settings[user_id] = entry["settings"]
+                if entry["rewrite"] is not None:
+                    rewrites[user_id] = entry["rewrite"]
+                elif entry["appends"]:
+                    appends[user_id] = entry["appends"]
+            self.in_flight = set(records) | set(evicted)
+            self.in_flight_entries = evicted
+            started = time.perf_counter()
+            try:
+                written, total_bytes, failed = await asyncio.to_thread(self.storage.write_batch, settings, appends, rewrites)
+            finally:
+                self.in_flight, self.in_flight_entries = set(), {}
+            elapsed = time.perf_counter() - started
+            for user_id, entry in evicted.items():
+                if user_id not in failed:
+                    if self.evicted.get(user_id) is entry:
+                        del self.evicted[user_id]
+                elif entry.get("revived"):
+                    # Revived while being written: its changes are not in storage after all
+                    self.restore_failed_changes(user_id, entry["record"], entry["settings"], entry["appends"], entry["rewrite"], entry["log_length"])
+            for user_id, messages in rewrites.items():
+                if user_id not in failed and user_id in records:
+                    self.set_log_length(user_id, len(messages))
+                    self.flush_stats["compactions"] += 1
+                    metrics.inc("nyxie_memory_compactions_total")
+            for user_id, messages in appends.items():
+                if user_id not in failed and user_id in records:
+                    self.set_log_length(user_id, self.written_log_length(user_id) + len(messages))
+            # Retry failed writes on the next flush; failed evicted entries are simply kept
+            for user_id in failed:
+                if user_id not in records:
+                    continue
+                self.restore_failed_changes(
+                    user_id, records[user_id],
+                    settings.get(user_id) if user_id in dirty else None,
+                    appends.get(user_id) or covered.get(user_id) or [],
+                    rewrites[user_id] if user_id in forced else None,
+                    self.written_log_length(user_id)
+                )
+            stats = self.flush_stats
+            stats["flushes"] += 1
+            stats["users_written"] += written
+            stats["bytes_written"] += total_bytes
+            stats["write_errors"] += len(failed)
+            metrics.inc("nyxie_memory_flushes_total")
+            metrics.inc("nyxie_memory_writes_total", written)
+            metrics.inc("nyxie_memory_bytes_written_total", total_bytes)
+            metrics.inc("nyxie_memory_write_errors_total", len(failed))
+            metrics.observe("nyxie_memory_flush_seconds", elapsed)
+            logger.debug(f"Memory flush: {written} writes, {total_bytes} bytes in {elapsed:.3f}s")
+
+    def written_log_length(self, user_id):
+        """Records in the user's stored log, whether the user is cached or evicted"""
+        entry = self.evicted.get(user_id)
+        if user_id not in self.users and entry is not None:
+            return entry["log_length"]
+        return self.log_lengths.get(user_id, 0)
+
+    def set_log_length(self, user_id, log_length):
+        if user_id in self.users:
+            self.log_lengths[user_id] = log_length
+        elif user_id in self.evicted:
+            self.evicted[user_id]["log_length"] = log_length
+
+    def restore_failed_changes(self, user_id, record, settings, appends, rewrite, log_length):
+        """Queue changes from a failed write again, whether the user is still cached or not"""
+        if user_id in self.users:
+            self.log_lengths[user_id] = log_length
+            self.requeue_changes(user_id, settings, appends, rewrite)
+        else:
+            self.merge_evicted_changes(user_id, record, settings, appends, rewrite, log_length)
+            self.evicted[user_id]["log_length"] = log_length
+
+    async def run_flush_loop(self):
+        """Flush dirty users periodically and compact logs less often, until cancelled"""
+        last_compaction = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            compact = time.monotonic() - last_compaction >= self.compact_interval
+            try:
+                await self.flush(compact=compact)
+                if compact:
+                    last_compaction = time.monotonic()
+            except Exception as e:
+                logger.error(f"Memory flush error: {e}", exc_info=True)
 
     def add_message(self, user_id, role, content):
         user_id = str(user_id)
         
         # Load user's memory if not already loaded
-        if user_id not in self.users:
-            self.load_user_memory(user_id)
+        record = self.get_user(user_id)
         
         # Normalize role for consistency
         normalized_role = "user" if role == "user" else "model"
@@ -206,97 +1585,448 @@ class UserMemory:
             "role": normalized_role,
             "content": content,
             "timestamp": datetime.now().isoformat(),
-            "tokens": len(content.split())  # Rough token estimation
+            "tokens": self.token_counter.count(content)
         }
         
-        # Update total tokens
-        self.users[user_id]["total_tokens"] = sum(msg.get("tokens", 0) for msg in self.users[user_id]["messages"])
+        # Keep the running total instead of re-summing the history
+        record["messages"].append(message)
+        record["total_tokens"] += message["tokens"]
+        size_delta = UserCache.message_size(message)
         
-        # Remove oldest messages if token limit exceeded
-        while self.users[user_id]["total_tokens"] > self.max_tokens and self.users[user_id]["messages"]:
-            removed_msg = self.users[user_id]["messages"].pop(0)
-            self.users[user_id]["total_tokens"] -= removed_msg.get("tokens", 0)
+        # Remove oldest messages if token limit exceeded; the log is trimmed by compaction
+        while record["total_tokens"] > self.max_tokens and len(record["messages"]) > 1:
+            size_delta -= self.drop_oldest_message(user_id, record)
         
-        self.users[user_id]["messages"].append(message)
-        self.save_user_memory(user_id)
+        self.pending_messages.setdefault(user_id, []).append(message)
+        self.users.resize(user_id, size_delta)
+        self.last_activity[user_id] = time.monotonic()
+
+    def drop_oldest_message(self, user_id, record=None):
+        """Remove the user's oldest message in O(1); returns its approximate size in bytes"""
+        record = record or self.get_user(user_id)
+        removed_msg = record["messages"].popleft()
+        record["total_tokens"] -= removed_msg.get("tokens", 0)
+        return UserCache.message_size(removed_msg)
+
+    def build_history_contents(self, user_id, budget_tokens):
+        """Pack the newest messages that fit in `budget_tokens` into Gemini `contents` turns.
+
+        Turn objects are cached per message, so only messages that are new since
+        the last call are formatted.
+        """
+        record = self.get_user(user_id)
+        turn_cache = record.get("_turn_cache", {})
+        new_cache = {}
+        turns = []
+        summary = record.get("summary")
+        summary_text = f"Summary of our earlier conversation: {summary}" if summary else None
+        used_tokens = record.get("summary_tokens", 0) if summary else 0
+        for msg in reversed(record["messages"]):
+            used_tokens += msg.get("tokens", 0)
+            if used_tokens > budget_tokens:
+                break
+            cached = turn_cache.get(id(msg))
+            # The message is kept alongside its turn so its id cannot be reused
+            if cached is None or cached[0] is not msg:
+                cached = (msg, {"role": msg["role"], "parts": [msg["content"]]})
+            new_cache[id(msg)] = cached
+            turns.append(cached[1])
+        record["_turn_cache"] = new_cache
+        turns.reverse()
+        # Conversations sent to Gemini start with a user turn
+        while turns and turns[0]["role"] != "user":
+            turns.pop(0)
+        if summary_text:
+            # Put the running summary in front of the first user turn; the cached turn is not modified
+            if turns:
+                turns[0] = {"role": "user", "parts": [summary_text] + turns[0]["parts"]}
+            else:
+                turns = [{"role": "user", "parts": [summary_text]}]
+        return turns
+
+    async def load_full_history(self, user_id):
+        """Replace a tail-loaded user's history with everything in storage plus the unsaved messages.
+
+        Returns False if the user left the cache in the meantime.
+        """
+        if user_id not in self.users:
+            return False
+        record = self.users.peek(user_id)
+        if record.get("_complete", True):
+            return True
+        # No flush runs meanwhile, so the log and the pending messages hold the whole history
+        async with self._flush_lock:
+            _, stored = await asyncio.to_thread(self.storage.load_user, user_id)
+            if user_id not in self.users or self.users.peek(user_id) is not record:
+                return False
+            messages = stored + self.pending_messages.get(user_id, [])
+            size_delta = sum(UserCache.message_size(msg) for msg in messages)
+            size_delta -= sum(UserCache.message_size(msg) for msg in record["messages"])
+            record["messages"] = deque(messages)
+            record["total_tokens"] = sum(msg.get("tokens", 0) for msg in messages)
+            while record["total_tokens"] > self.max_tokens and len(record["messages"]) > 1:
+                size_delta -= self.drop_oldest_message(user_id, record)
+            del record["_complete"]
+            self.log_lengths[user_id] = len(stored)
+            self.users.resize(user_id, size_delta)
+        return True
+
+    def messages_outside_window(self, user_id, keep_tokens):
+        """Oldest messages that are not part of the newest `keep_tokens` tokens of history"""
+        messages = self.users.peek(user_id)["messages"]
+        kept_tokens, kept = 0, 0
+        for msg in reversed(messages):
+            if kept_tokens + msg.get("tokens", 0) > keep_tokens:
+                break
+            kept_tokens += msg.get("tokens", 0)
+            kept += 1
+        return list(islice(messages, len(messages) - kept))
+
+    def apply_summary(self, user_id, summary, folded_messages):
+        """Replace `folded_messages` with the new running summary.
+
+        Messages may have been trimmed while the summary was generated, so only
+        the ones still at the front of the history are removed.
+        """
+        if user_id not in self.users:
+            return
+        record = self.users.peek(user_id)
+        folded_ids = {id(msg) for msg in folded_messages}
+        size_delta = 0
+        while record["messages"] and id(record["messages"][0]) in folded_ids:
+            size_delta -= self.drop_oldest_message(user_id, record)
+        record["summary"] = summary
+        record["summary_tokens"] = self.token_counter.count(summary)
+        self.users.resize(user_id, size_delta)
+        # Rewrite the log on the next flush so the folded messages do not come back on reload
+        self.needs_rewrite.add(user_id)
+        self.mark_dirty(user_id)
+
+class GeminiSummarizer:
+    """Folds old messages into a running summary with a Gemini call"""
+
+    def __init__(self, call=None):
+        # `call(kind, user_lang, contents)`; defaults to the shared resilient call layer
+        self.call = call or call_gemini
+
+    async def __call__(self, previous_summary, messages):
+        transcript = "\n".join(
+            f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
+            for msg in messages
+        )
+        prompt = f"""Update the running summary of a conversation between a user and Nyxie.
+Keep facts about the user, their preferences, ongoing topics and promises made.
+Write at most a few short paragraphs in the language the conversation uses.
+
+Current summary:
+{previous_summary or "(empty)"}
+
+New messages to fold in:
+{transcript}
+
+Updated summary:"""
+        response = await self.call('summary', None, prompt)
+        return extract_response_text(response).strip()
+
+
+class HistoryCompactor:
+    """Background stage that folds history outside the recent window into a stored summary.
+
+    Only users idle for `idle_seconds` are compacted, each at most once per
+    `user_interval` seconds and no more than `max_per_minute` summaries overall.
+    `summarizer` is any `async (previous_summary, messages) -> str` callable.
+    """
+
+    def __init__(self, memory, summarizer, keep_tokens=4000, min_fold_tokens=1000,
+                 idle_seconds=120, user_interval=600, max_per_minute=10):
+        self.memory = memory
+        self.summarizer = summarizer
+        self.keep_tokens = keep_tokens
+        self.min_fold_tokens = min_fold_tokens
+        self.idle_seconds = idle_seconds
+        self.user_interval = user_interval
+        self.max_per_minute = max_per_minute
+        self.last_compacted = {}
+        self.recent_runs = deque()
+        self.stats = {"summaries": 0, "messages_folded": 0, "errors": 0}
+
+    def candidates(self, now):
+        for user_id, last_seen in list(self.memory.last_activity.items()):
+            if user_id not in self.memory.users or now - last_seen < self.idle_seconds:
+                continue
+            if now - self.last_compacted.get(user_id, float("-inf")) < self.user_interval:
+                continue
+            yield user_id
+
+    async def run_once(self, now=None):
+        """Compact every eligible user within the rate limit; returns how many were summarized"""
+        now = time.monotonic() if now is None else now
+        while self.recent_runs and now - self.recent_runs[0] >= 60:
+            self.recent_runs.popleft()
+        compacted = 0
+        for user_id in self.candidates(now):
+            if len(self.recent_runs) >= self.max_per_minute:
+                break
+            try:
+                # Older messages have to be folded too, so the whole history is needed
+                if not await self.memory.load_full_history(user_id):
+                    continue
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Loading full history failed for user {user_id}: {e}")
+                continue
+            folded = self.memory.messages_outside_window(user_id, self.keep_tokens)
+            if sum(msg.get("tokens", 0) for msg in folded) < self.min_fold_tokens:
+                continue
+            self.last_compacted[user_id] = now
+            self.recent_runs.append(now)
+            previous_summary = self.memory.users.peek(user_id).get("summary")
+            try:
+                summary = await self.summarizer(previous_summary, folded)
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"History summarization failed for user {user_id}: {e}")
+                continue
+            if not summary:
+                continue
+            self.memory.apply_summary(user_id, summary, folded)
+            self.stats["summaries"] += 1
+            self.stats["messages_folded"] += len(folded)
+            compacted += 1
+        return compacted
+
+    async def run_loop(self, interval):
+        """Check for idle users every `interval` seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"History compaction error: {e}", exc_info=True)
+
+
+def create_history_compactor(memory):
+    """Build the summarization stage from the HISTORY_SUMMARY_* settings"""
+    return HistoryCompactor(
+        memory,
+        GeminiSummarizer(),
+        keep_tokens=int(os.getenv("HISTORY_SUMMARY_KEEP_TOKENS", "4000")),
+        min_fold_tokens=int(os.getenv("HISTORY_SUMMARY_MIN_FOLD_TOKENS", "1000")),
+        idle_seconds=float(os.getenv("HISTORY_SUMMARY_IDLE_SECONDS", "120")),
+        user_interval=float(os.getenv("HISTORY_SUMMARY_USER_INTERVAL", "600")),
+        max_per_minute=int(os.getenv("HISTORY_SUMMARY_MAX_PER_MINUTE", "10"))
+    )
+
+# Phrases that change a user's settings; INTENT_PATTERNS_FILE can replace either table.
+# Phrases match whole words; a trailing '*' also accepts suffixes ('konuş*' matches 'konuşur musun')
+LANGUAGE_PATTERNS = {
+    'tr': ['türkçe konuş*', 'türkçe olarak konuş*', 'türkçeye geç*', 'benimle türkçe konuş*'],
+    'en': ['speak english', 'talk in english', 'switch to english', 'use english'],
+    'es': ['habla español', 'hablar en español', 'cambiar a español'],
+    'fr': ['parle français', 'parler en français', 'passe en français'],
+    'de': ['sprich deutsch', 'auf deutsch sprechen', 'wechsle zu deutsch'],
+    'it': ['parla italiano', 'parlare in italiano', 'passa all\'italiano'],
+    'pt': ['fale português', 'falar em português', 'mude para português']
+}
+
+TIMEZONE_PATTERNS = {
+    'Europe/Istanbul': ['istanbul', 'türkiye', 'ankara', 'izmir'],
+    'America/New_York': ['new york', 'nyc', 'eastern time'],
+    'Europe/London': ['london', 'uk', 'britain', 'england'],
+    'Asia/Tokyo': ['tokyo', 'japan', 'japanese'],
+    'Europe/Paris': ['paris', 'france', 'french'],
+    'Asia/Dubai': ['dubai', 'uae', 'emirates']
+}
+
+def normalize_intent_text(text):
+    # str.lower() turns 'İ' into 'i' plus a combining dot; fold it so 'İstanbul' matches 'istanbul'
+    return text.lower().replace("i\u0307", "i")
+
+class IntentMatcher:
+    """Matches every intent table against a message with one precompiled regex.
+
+    `tables` maps a table name ('language', 'timezone') to {value: [phrases]}.
+    Phrases match only as whole words, so short ones like 'uk' no longer fire
+    inside other words, and longer phrases win over their prefixes. For each
+    table, the phrase mentioned first in the message wins.
+    """
+
+    def __init__(self, tables):
+        self.tables = set(tables)
+        targets = {}
+        for table, entries in tables.items():
+            for value, phrases in entries.items():
+                for phrase in phrases:
+                    key = " ".join(normalize_intent_text(phrase).split())
+                    if key:
+                        targets.setdefault(key, {}).setdefault(table, value)
+        # One named group per phrase; match.lastgroup tells which phrase matched
+        self.targets = {}
+        alternatives = []
+        for index, key in enumerate(sorted(targets, key=len, reverse=True)):
+            body = r"\s+".join(re.escape(word) for word in key.rstrip("*").split())
+            if key.endswith("*"):
+                body += r"\w*"
+            alternatives.append(f"(?P<p{index}>{body})")
+            self.targets[f"p{index}"] = targets[key]
+        # The first-character lookahead rejects most word starts before trying any alternative
+        first_chars = "".join(sorted({re.escape(key[0]) for key in targets}))
+        self.regex = re.compile(rf"(?<!\w)(?=[{first_chars}])(?:{'|'.join(alternatives)})(?!\w)") if alternatives else None
+
+    def match(self, text):
+        """{table: value} for each table with a phrase in the text"""
+        found = {}
+        if self.regex is None:
+            return found
+        for match in self.regex.finditer(normalize_intent_text(text)):
+            for table, value in self.targets[match.lastgroup].items():
+                found.setdefault(table, value)
+            if len(found) == len(self.tables):
+                break
+        return found
+
+def load_intent_matcher(path=None):
+    """Build the matcher from the built-in tables, replaced by any tables in a JSON file"""
+    tables = {"language": LANGUAGE_PATTERNS, "timezone": TIMEZONE_PATTERNS}
+    if path:
+        with open(path, encoding="utf-8") as f:
+            tables.update(json.load(f))
+        for timezone in list(tables.get("timezone", {})):
+            try:
+                ZoneInfo(timezone)
+            except Exception:
+                logger.warning(f"Ignoring unknown timezone '{timezone}' in {path}")
+                tables["timezone"] = {tz: p for tz, p in tables["timezone"].items() if tz != timezone}
+        logger.info(f"Intent patterns loaded from {path}")
+    return IntentMatcher(tables)
 
-    def get_relevant_context(self, user_id, max_messages=10):
-        """Get relevant conversation context for the user"""
-        user_id = str(user_id)
-        if user_id not in self.users:
-            self.load_user_memory(user_id)
-            
-        messages = self.users[user_id].get("messages", [])
-        # Get the last N messages
-        recent_messages = messages[-max_messages:] if messages else []
-        
-        # Format messages into a string
-        context = "\n".join([
-            f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
-            for msg in recent_messages
-        ])
-        
-        return context
+intent_matcher = load_intent_matcher(os.getenv("INTENT_PATTERNS_FILE"))
+
+@lru_cache(maxsize=64)
+def match_intents(message_text):
+    # Both detectors below run on the same message; the cache keeps it to one scan
+    return intent_matcher.match(message_text)
 
 def detect_language_intent(message_text):
     """Detect if user wants to change language from natural language"""
-    message_lower = message_text.lower()
-    language_patterns = {
-        'tr': ['türkçe konuş', 'türkçe olarak konuş', 'türkçeye geç', 'benimle türkçe konuş'],
-        'en': ['speak english', 'talk in english', 'switch to english', 'use english'],
-        'es': ['habla español', 'hablar en español', 'cambiar a español'],
-        'fr': ['parle français', 'parler en français', 'passe en français'],
-        'de': ['sprich deutsch', 'auf deutsch sprechen', 'wechsle zu deutsch'],
-        'it': ['parla italiano', 'parlare in italiano', 'passa all\'italiano'],
-        'pt': ['fale português', 'falar em português', 'mude para português']
-    }
-    
-    for lang, patterns in language_patterns.items():
-        if any(pattern in message_lower for pattern in patterns):
-            return lang
-    return None
+    return match_intents(message_text).get('language')
 
 def detect_settings_from_message(message_text):
     """Detect user preferences from natural language messages"""
     settings = {}
-    
-    # Timezone detection
-    timezone_patterns = {
-        'Europe/Istanbul': ['istanbul', 'türkiye', 'ankara', 'izmir'],
-        'America/New_York': ['new york', 'nyc', 'eastern time', 'et'],
-        'Europe/London': ['london', 'uk', 'britain', 'england'],
-        'Asia/Tokyo': ['tokyo', 'japan', 'japanese'],
-        'Europe/Paris': ['paris', 'france', 'french'],
-        'Asia/Dubai': ['dubai', 'uae', 'emirates']
-    }
-    
-    message_lower = message_text.lower()
-    
-    # Check for timezone mentions
-    for tz, patterns in timezone_patterns.items():
-        if any(pattern in message_lower for pattern in patterns):
-            settings['timezone'] = tz
-            break
-    
+    timezone = match_intents(message_text).get('timezone')
+    if timezone:
+        settings['timezone'] = timezone
     return settings
 
-def add_random_emojis(text, count=2):
-    """Add random positive emojis to text"""
+def pick_emoji_affixes(count=2):
+    """Pick the random emoji prefix and suffix that wrap a reply"""
     positive_emojis = ['✨', '💫', '🌟', '💖', '💝', '💕', '💞', '💓', '💗', '💜', '💙', '💚', '🧡', '❤️', '😊', '🥰', '😍']
     selected_emojis = random.sample(positive_emojis, min(count, len(positive_emojis)))
-    return f"{' '.join(selected_emojis)} {text} {' '.join(random.sample(positive_emojis, min(count, len(positive_emojis))))}"
+    closing_emojis = random.sample(positive_emojis, min(count, len(positive_emojis)))
+    return f"{' '.join(selected_emojis)} ", f" {' '.join(closing_emojis)}"
+
+def add_random_emojis(text, count=2):
+    """Add random positive emojis to text"""
+    prefix, suffix = pick_emoji_affixes(count)
+    return f"{prefix}{text}{suffix}"
 
 # Dynamic multi-language support
-def detect_and_set_user_language(message_text, user_id):
-    try:
-        # Detect language from user's message
-        detected_lang = langdetect.detect(message_text)
-        user_memory.update_user_settings(user_id, {'language': detected_lang})
-        return detected_lang
-    except:
-        # If detection fails, get user's existing language or default to 'en'
-        user_settings = user_memory.get_user_settings(user_id)
-        return user_settings.get('language', 'en')
+class LanguageDetector:
+    """Per-user language detection with langdetect, cheap enough to run on every message.
+
+    Messages with fewer than `min_letters` letters are skipped. A user's
+    language only switches after `switch_votes` consecutive detections of
+    another language with at least `min_confidence`. Once the current language
+    has been confirmed `stable_after` times, only every `recheck_every`-th
+    message is checked again.
+    """
+
+    def __init__(self, min_letters=20, min_confidence=0.9, switch_votes=2, stable_after=3,
+                 recheck_every=3, max_users=10000, seed=0):
+        self.min_letters = min_letters
+        self.min_confidence = min_confidence
+        self.switch_votes = switch_votes
+        self.stable_after = stable_after
+        self.recheck_every = recheck_every
+        self.max_users = max_users
+        self.seed = seed
+        self.states = OrderedDict()
+        self.stats = {"skipped_short": 0, "skipped_stable": 0, "detections": 0, "switches": 0}
+        self._detect_langs = None
+
+    def preload(self):
+        """Load the language profiles now rather than on the first user's message"""
+        from langdetect import DetectorFactory, detect_langs
+        from langdetect.detector_factory import init_factory
+        # langdetect samples n-grams at random; a fixed seed makes results repeatable
+        DetectorFactory.seed = self.seed
+        init_factory()
+        self._detect_langs = detect_langs
+
+    def detect(self, text):
+        """(language, probability) of the most likely language, or None"""
+        if self._detect_langs is None:
+            self.preload()
+        try:
+            best = self._detect_langs(text)[0]
+        except Exception:
+            # LangDetectException: nothing in the text to detect from
+            return None
+        self.stats["detections"] += 1
+        return best.lang, best.prob
+
+    def observe(self, user_id, text, current_lang):
+        """Feed one of the user's messages; returns the new language when the user switched, else None"""
+        state = self.states.get(user_id)
+        if state is None:
+            state = {"confirmed": 0, "candidate": None, "votes": 0, "since_check": 0}
+            self.states[user_id] = state
+            if len(self.states) > self.max_users:
+                self.states.popitem(last=False)
+        else:
+            self.states.move_to_end(user_id)
+
+        if sum(ch.isalpha() for ch in text) < self.min_letters:
+            self.stats["skipped_short"] += 1
+            return None
+        state["since_check"] += 1
+        if state["confirmed"] >= self.stable_after and state["since_check"] < self.recheck_every:
+            self.stats["skipped_stable"] += 1
+            return None
+        state["since_check"] = 0
+
+        result = self.detect(text)
+        if result is None or result[1] < self.min_confidence:
+            return None
+        lang = result[0]
+        if lang == current_lang:
+            state.update(confirmed=state["confirmed"] + 1, candidate=None, votes=0)
+            return None
+        # Another language showed up: check every message until it is settled either way
+        state["confirmed"] = 0
+        if state["candidate"] == lang:
+            state["votes"] += 1
+        else:
+            state.update(candidate=lang, votes=1)
+        if state["votes"] < self.switch_votes:
+            return None
+        state.update(confirmed=1, candidate=None, votes=0)
+        self.stats["switches"] += 1
+        return lang
+
+
+def create_language_detector():
+    """Build the language detector, or None when LANGUAGE_DETECTION=0"""
+    if os.getenv("LANGUAGE_DETECTION", "1") != "1":
+        return None
+    return LanguageDetector(
+        min_letters=int(os.getenv("LANGUAGE_DETECTION_MIN_LETTERS", "20")),
+        min_confidence=float(os.getenv("LANGUAGE_DETECTION_MIN_CONFIDENCE", "0.9")),
+        switch_votes=int(os.getenv("LANGUAGE_DETECTION_SWITCH_VOTES", "2"))
+    )
+
+language_detector = create_language_detector()
 
 def get_analysis_prompt(media_type, caption, lang):
     """Dynamically generate analysis prompts in the detected language"""
@@ -341,53 +2071,308 @@ def get_analysis_prompt(media_type, caption, lang):
     # Return prompt in specified language, default to English
     return prompts.get(lang, prompts['en'])
 
+# Markdown constructs a split must not cut through: fenced code blocks, inline code, bold and links
+MARKDOWN_SPAN_RE = re.compile(
+    r"```[^`]*(?:`(?!``)[^`]*)*(?:```|\Z)"
+    r"|`[^`\n]+`"
+    r"|\*\*[^\n]+?\*\*"
+    r"|__[^\n]+?__"
+    r"|\[[^\]\n]+\]\([^)\s]+\)"
+)
+# Preferred places to split, best first
+SPLIT_SEPARATORS = ("\n\n", "\n", ". ", "! ", "? ", "; ", ", ", " ")
+
+def find_cut(text, start, end):
+    """Best split position in (start, end]: the latest paragraph, line, sentence or word break"""
+    # Prefer a break in the second half of the window so chunks are not tiny
+    for min_cut in (start + (end - start) // 2, start + 1):
+        for separator in SPLIT_SEPARATORS:
+            cut = text.rfind(separator, min_cut, end)
+            if cut >= min_cut:
+                return cut + len(separator)
+    return end
+
+CODE_FENCE_CLOSE = "\n```"
+
+def code_fence_opener(text, fence_start, max_length):
+    """Fence line to repeat when a code block continues in the next chunk.
+
+    The original opener (with its language tag) is reused only when it is a
+    short line of its own. Otherwise a bare fence is used, or nothing at all
+    when even that would take half of a chunk.
+    """
+    opener_end = text.find("\n", fence_start)
+    opener = text[fence_start:opener_end + 1] if opener_end != -1 else ""
+    if opener and "`" not in opener[3:] and len(opener) < max_length // 2:
+        return opener
+    return "```\n" if len("```\n") < max_length // 2 else ""
+
+def split_message(text, max_length=4096):
+    """Split `text` into chunks of at most `max_length` characters in one pass.
+
+    Blank lines are kept. Splits happen at paragraph, line, sentence or word
+    boundaries, never inside inline code, bold or links. A code block longer
+    than a chunk is closed at a line break and reopened in the next chunk.
+    """
+    if max_length < 1:
+        raise ValueError("max_length must be positive")
+    spans = [match.span() for match in MARKDOWN_SPAN_RE.finditer(text)]
+    span_starts = [span[0] for span in spans]
+    chunks = []
+    position, length = 0, len(text)
+    reopen = ""  # Code fence opener to repeat at the start of the next chunk
+    while position < length:
+        budget = max_length - len(reopen)
+        if length - position <= budget:
+            chunks.append(reopen + text[position:])
+            break
+        end = position + budget
+        cut = find_cut(text, position, end)
+
+        # Move the cut out of any Markdown span it falls into
+        index = bisect_left(span_starts, cut) - 1
+        span = spans[index] if index >= 0 and spans[index][1] > cut else None
+        if span and span[0] > position:
+            cut = span[0]
+        elif span and text.startswith("```", span[0]) and budget > len(CODE_FENCE_CLOSE):
+            # A code block that does not fit: close it here and reopen it in the next chunk
+            limit = end - len(CODE_FENCE_CLOSE)
+            cut = text.rfind("\n", position + 1, limit)
+            if cut <= position:
+                cut = limit
+            chunks.append(reopen + text[position:cut] + CODE_FENCE_CLOSE)
+            reopen = code_fence_opener(text, span[0], max_length)
+            position = cut + 1 if text[cut] == "\n" else cut
+            continue
+
+        chunks.append(reopen + text[position:cut])
+        reopen = ""
+        position = cut
+    return [chunk.rstrip() for chunk in chunks if chunk.strip()]
+
 async def split_and_send_message(update: Update, text: str, max_length: int = 4096):
     """Uzun mesajları böler ve sırayla gönderir"""
     if not text:  # Boş mesaj kontrolü
-        await update.message.reply_text("Üzgünüm, bir yanıt oluşturamadım. Lütfen tekrar dener misin? 🙏")
+        await send_reply(update, "Üzgünüm, bir yanıt oluşturamadım. Lütfen tekrar dener misin? 🙏")
         return
         
-    messages = []
-    current_message = ""
-    
-    # Mesajı satır satır böl
-    lines = text.split('\n')
-    
-    for line in lines:
-        if not line:  # Boş satır kontrolü
-            continue
-            
-        # Eğer mevcut satır eklenince maksimum uzunluğu aşacaksa
-        if len(current_message + line + '\n') > max_length:
-            # Mevcut mesajı listeye ekle ve yeni mesaj başlat
-            if current_message.strip():  # Boş mesaj kontrolü
-                messages.append(current_message.strip())
-            current_message = line + '\n'
-        else:
-            current_message += line + '\n'
-    
-    # Son mesajı ekle
-    if current_message.strip():  # Boş mesaj kontrolü
-        messages.append(current_message.strip())
+    # Mesajı tek geçişte, Markdown yapısını bozmadan böl
+    messages = split_message(text, max_length)
     
     # Eğer hiç mesaj oluşturulmadıysa
     if not messages:
-        await update.message.reply_text("Üzgünüm, bir yanıt oluşturamadım. Lütfen tekrar dener misin? 🙏")
+        await send_reply(update, "Üzgünüm, bir yanıt oluşturamadım. Lütfen tekrar dener misin? 🙏")
         return
         
-    # Mesajları sırayla gönder
-    for message in messages:
-        if message.strip():  # Son bir boş mesaj kontrolü
-            await update.message.reply_text(message)
+    # Mesajları kuyruğa sırayla ekle; kuyruk sırayı ve hız sınırlarını korur
+    pending = [
+        outbound_sender.submit(update.effective_chat.id, partial(update.message.reply_text, message))
+        for message in messages if message.strip()  # Son bir boş mesaj kontrolü
+    ]
+    await asyncio.gather(*pending)
+
+def retry_after_seconds(error):
+    """RetryAfter.retry_after is an int in older PTB releases and a timedelta in newer ones"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+class TokenBucket:
+    """Token bucket where waiting callers reserve tokens in advance, so they are served in order"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Take one token and return how long to wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def is_idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class OutboundSender:
+    """Central queue for outgoing Telegram requests.
+
+    Each chat has a FIFO queue drained by one worker, so chunks of a reply keep
+    their order. Every request waits for a token from its chat's bucket and
+    from the global bucket, which keeps the bot under Telegram's flood limits.
+    RetryAfter errors are slept off and retried. `make_request` is a
+    zero-argument function returning a new awaitable per attempt.
+    """
+
+    def __init__(self, global_rate=25.0, chat_rate=1.0, chat_burst=3, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.queues = {}
+        self.workers = {}
+        self.chat_buckets = {}
+        self.queue_depth = 0
+        self.stats = {
+            "sent": 0,
+            "errors": 0,
+            "retry_after": 0,
+            "max_queue_depth": 0
+        }
+
+    def submit(self, chat_id, make_request):
+        """Queue a request for `chat_id`; returns a future with its result"""
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(chat_id, deque()).append((make_request, future, time.monotonic()))
+        self.queue_depth += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue_depth)
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return future
+
+    async def send(self, chat_id, make_request):
+        return await self.submit(chat_id, make_request)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Forget buckets of chats that have been quiet long enough to be full again
+            for idle_chat in [c for c, b in self.chat_buckets.items() if c not in self.workers and b.is_idle()]:
+                del self.chat_buckets[idle_chat]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _drain(self, chat_id):
+        queue = self.queues[chat_id]
+        try:
+            while queue:
+                make_request, future, enqueued_at = queue.popleft()
+                self.queue_depth -= 1
+                if future.cancelled():
+                    continue
+                try:
+                    result = await self._send_with_retries(chat_id, make_request)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    outcome = "error"
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    self.stats["sent"] += 1
+                    outcome = "ok"
+                    if not future.cancelled():
+                        future.set_result(result)
+                # Time from submit to done, including the queue and rate-limit waits
+                metrics.observe("nyxie_telegram_send_seconds", time.monotonic() - enqueued_at, outcome=outcome)
+        finally:
+            del self.workers[chat_id]
+            if not queue:
+                del self.queues[chat_id]
+
+    async def _send_with_retries(self, chat_id, make_request):
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await make_request()
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.stats["retry_after"] += 1
+                metrics.inc("nyxie_telegram_retry_after_total")
+                delay = retry_after_seconds(e)
+                logger.warning(f"Flood control for chat {chat_id}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+outbound_sender = OutboundSender(
+    global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", "25")),
+    chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", "1")),
+    chat_burst=int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+)
+
+async def send_reply(update: Update, text: str):
+    """Reply to the update's message through the outbound queue"""
+    if not update.effective_chat:
+        return await update.message.reply_text(text)
+    return await outbound_sender.send(update.effective_chat.id, lambda: update.message.reply_text(text))
+
+def find_split_point(text, max_length):
+    """Where to cut `text` so the first part fits in `max_length`, preferring line then word breaks"""
+    if len(text) <= max_length:
+        return len(text)
+    for separator in ('\n', ' '):
+        cut = text.rfind(separator, 0, max_length)
+        if cut > 0:
+            return cut + 1
+    return max_length
+
+async def stream_and_send_message(update: Update, chunks, prefix="", suffix="", max_length: int = 4096):
+    """Send a streamed reply: post the first chunk immediately and edit it as text arrives.
+
+    Edits are throttled to STREAM_EDIT_INTERVAL and the reply rolls over into a
+    new message when it passes `max_length`. Returns the full text that was sent.
+    """
+    sent_text = ""       # Text already committed to finished messages
+    current_message = None
+    current_text = ""    # Text of the message that is still being edited
+    shown_text = ""      # What Telegram currently shows for that message
+    next_edit = 0.0
+    full_text = ""
+
+    async def show(text, force=False):
+        nonlocal current_message, shown_text, next_edit
+        now = time.monotonic()
+        if current_message is None:
+            current_message = await send_reply(update, text)
+            shown_text, next_edit = text, time.monotonic() + STREAM_EDIT_INTERVAL
+        elif text != shown_text and (force or now >= next_edit):
+            # The outbound queue applies the rate limits and sleeps off RetryAfter
+            await outbound_sender.send(update.effective_chat.id, partial(current_message.edit_text, text))
+            shown_text, next_edit = text, time.monotonic() + STREAM_EDIT_INTERVAL
+
+    async def add_text(text, final=False):
+        nonlocal current_text, current_message, shown_text, sent_text
+        current_text += text
+        # Finish full messages and continue in a new one
+        while len(current_text) > max_length:
+            cut = find_split_point(current_text, max_length)
+            await show(current_text[:cut], force=True)
+            sent_text += current_text[:cut]
+            current_text = current_text[cut:]
+            current_message, shown_text = None, ""
+        if current_text.strip():
+            await show(current_text, force=final)
+
+    got_text = False
+    async for chunk in chunks:
+        if not got_text:
+            got_text = True
+            chunk = prefix + chunk
+        full_text += chunk
+        await add_text(chunk)
+
+    if not got_text:
+        await send_reply(update, "Üzgünüm, bir yanıt oluşturamadım. Lütfen tekrar dener misin? 🙏")
+        return ""
+
+    full_text += suffix
+    await add_text(suffix, final=True)
+    return full_text
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     welcome_message = "Hello! I'm Nyxie, a Protogen created by Stixyie. I'm here to chat, help, and learn with you! Feel free to talk to me about anything or share images with me. I'll automatically detect your language and respond accordingly."
-    await update.message.reply_text(welcome_message)
+    await send_reply(update, welcome_message)
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Comprehensive logging for debugging
-    logger.info("Entering handle_message function")
-    
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text=None):
     try:
         # Validate update object
         if not update:
@@ -399,18 +2384,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error("Message is None in update object")
             return
         
-        # Log message details for debugging
-        logger.info(f"Message received: {update.message}")
-        logger.info(f"Message text: {update.message.text}")
-        logger.info(f"Message type: {type(update.message)}")
-        
         user_id = str(update.effective_user.id)
-        logger.info(f"User ID: {user_id}")
         
         # Get user's current language settings from memory
-        user_settings = user_memory.get_user_settings(user_id)
+        with stage_span("memory_load"):
+            await user_memory.ensure_loaded(user_id)
+            user_settings = user_memory.get_user_settings(user_id)
         user_lang = user_settings.get('language', 'tr')  # Default to Turkish if not set
-        logger.info(f"User language: {user_lang}")
         
         # Check for media types
         if update.message.photo:
@@ -425,15 +2405,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Process text messages
         if update.message.text:
-            # Normalize and strip the message text
-            message_text = update.message.text.strip()
-            logger.info(f"Processed message text: {message_text}")
+            # Normalize and strip the message text; coalesced messages arrive already merged
+            message_text = (message_text or update.message.text).strip()
             
             # Language detection and settings
             detected_lang = detect_language_intent(message_text)
             if detected_lang:
-                user_memory.update_user_settings(user_id, {'language': detected_lang})
+                # An explicit request pins the language so automatic detection does not undo it
+                user_memory.update_user_settings(user_id, {'language': detected_lang, 'language_pinned': True})
                 logger.info(f"Language updated to: {detected_lang}")
+            elif language_detector and not user_settings.get('language_pinned'):
+                detected_lang = language_detector.observe(user_id, message_text, user_lang)
+                if detected_lang:
+                    user_memory.update_user_settings(user_id, {'language': detected_lang})
+                    logger.info(f"Language detected as: {detected_lang}")
+            if detected_lang:
+                user_lang = detected_lang
             
             # Check for settings changes
             settings_change = detect_settings_from_message(message_text)
@@ -451,113 +2438,327 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Prepare context for AI response
             try:
-                # Retrieve relevant conversation context
-                context_messages = user_memory.get_relevant_context(user_id)
-                
-                # Prepare personality context
-                personality_context = get_time_aware_personality(
-                    datetime.now(), 
-                    user_lang,
-                    user_settings.get('timezone', 'Europe/Istanbul')
-                )
+                with stage_span("prompt_build"):
+                    # Recent conversation turns that fit in the model's history budget
+                    history_contents = user_memory.build_history_contents(
+                        user_id,
+                        get_context_budget(model_registry.model_name('text'))
+                    )
+                    
+                    # The static prefix is the model's system instruction; only the time block and message are sent
+                    ai_prompt = build_request_prompt('text', user_settings.get('timezone', 'Europe/Istanbul'), message_text)
+                    
+                    # Generate AI response
+                    contents = history_contents + [{"role": "user", "parts": [ai_prompt]}]
                 
-                # Construct AI prompt
-                ai_prompt = f"""DİKKAT: BU YANITI TAMAMEN TÜRKÇE VERECEKSIN!
-SADECE TÜRKÇE KULLAN! KESİNLİKLE BAŞKA DİL KULLANMA!
-
-{personality_context}
-
-Görevin: Kullanıcının mesajını Türkçe olarak zeki ve samimi bir şekilde yanıtla.
-Rol: Sen Nyxie'sin ve kullanıcıyla Türkçe sohbet ediyorsun.
-
-Yönergeler:
-1. SADECE TÜRKÇE KULLAN
-2. Doğal ve samimi bir dil kullan
-3. Kültürel bağlama uygun ol
-4. Kısa ve öz cevaplar ver
-
-Kullanıcının mesajı: {message_text}"""
+                if STREAM_RESPONSES:
+                    # Show the reply while it is being generated
+                    prefix, suffix = pick_emoji_affixes()
+                    with stage_span("gemini_stream"):
+                        response_text = await stream_and_send_message(
+                            update,
+                            stream_gemini('text', user_lang, contents),
+                            prefix,
+                            suffix
+                        )
+                    if response_text:
+                        with stage_span("save"):
+                            user_memory.add_message(user_id, "user", message_text)
+                            user_memory.add_message(user_id, "assistant", response_text)
+                    return
                 
-                # Generate AI response
-                model = genai.GenerativeModel('gemini-2.0-flash-exp')
-                response = model.generate_content(ai_prompt)
+                with stage_span("gemini"):
+                    response = await call_gemini('text', user_lang, contents, hedge=True)
                 
                 # Extract response text
-                response_text = response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
+                response_text = extract_response_text(response)
                 
                 # Add emojis
                 response_text = add_random_emojis(response_text)
                 
                 # Save interaction to memory
-                user_memory.add_message(user_id, "user", message_text)
-                user_memory.add_message(user_id, "assistant", response_text)
+                with stage_span("save"):
+                    user_memory.add_message(user_id, "user", message_text)
+                    user_memory.add_message(user_id, "assistant", response_text)
                 
                 # Send response
-                await split_and_send_message(update, response_text)
+                with stage_span("send"):
+                    await split_and_send_message(update, response_text)
             
             except Exception as ai_error:
+                set_turn_outcome("error")
                 logger.error(f"AI response generation error: {ai_error}", exc_info=True)
                 error_message = "Üzgünüm, yanıt oluştururken bir sorun yaşadım. Lütfen tekrar deneyin. 🙏"
-                await update.message.reply_text(error_message)
+                await send_reply(update, error_message)
         
         else:
             logger.warning("Unhandled message type received")
-            await update.message.reply_text("Bu mesaj türünü şu anda işleyemiyorum. 🤔")
+            await send_reply(update, "Bu mesaj türünü şu anda işleyemiyorum. 🤔")
     
     except Exception as e:
+        set_turn_outcome("error")
         logger.error(f"Mesaj işleme hatası: {e}", exc_info=True)
         error_message = "Üzgünüm, mesajını işlerken bir sorun oluştu. Lütfen tekrar dener misin? 🙏"
-        await update.message.reply_text(error_message)
+        await send_reply(update, error_message)
+
+class MediaAnalysisCache:
+    """Disk-backed cache of media analysis replies, shared by all users.
+
+    Keys combine the media identity (Telegram file_unique_id, or the SHA-256 of
+    the bytes once the file is downloaded), the user's language and the
+    normalized caption. Entries expire after `ttl` seconds and the least
+    recently used ones are dropped beyond `max_entries`.
+    """
+
+    def __init__(self, db_path="media_cache.db", ttl=7 * 24 * 3600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"id_lookups": 0, "id_hits": 0, "content_lookups": 0, "content_hits": 0, "stores": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS media_cache ("
+                "key TEXT PRIMARY KEY, "
+                "response TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_media_cache_last_used ON media_cache (last_used)"
+            )
+            self.connection.execute("DELETE FROM media_cache WHERE created < ?", (time.time() - ttl,))
+
+    @staticmethod
+    def key(kind, source, digest, lang, prompt):
+        """Cache key for one piece of media asked about with one prompt"""
+        normalized = " ".join(prompt.casefold().split())
+        prompt_hash = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        return f"{kind}:{source}:{digest}:{lang}:{prompt_hash}"
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock, self.connection:
+            row = self.connection.execute(
+                "SELECT response FROM media_cache WHERE key = ? AND created >= ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE media_cache SET last_used = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+
+    def _put(self, keys, response):
+        now = time.time()
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO media_cache (key, response, created, last_used) VALUES (?, ?, ?, ?)",
+                [(key, response, now, now) for key in keys]
+            )
+            excess = self.connection.execute("SELECT COUNT(*) FROM media_cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM media_cache WHERE key IN "
+                    "(SELECT key FROM media_cache ORDER BY last_used LIMIT ?)",
+                    (excess,)
+                )
+                self.stats["evictions"] += excess
+
+    async def get(self, key):
+        """Cached reply for a key, or None; counted as an id or content lookup"""
+        kind = "id" if key.split(":", 2)[1] == "id" else "content"
+        self.stats[f"{kind}_lookups"] += 1
+        response = await asyncio.to_thread(self._get, key)
+        if response is not None:
+            self.stats[f"{kind}_hits"] += 1
+        metrics.inc("nyxie_media_cache_lookups_total", key=kind, result="miss" if response is None else "hit")
+        return response
+
+    async def put(self, keys, response):
+        self.stats["stores"] += 1
+        await asyncio.to_thread(self._put, keys, response)
+
+    @property
+    def hit_ratio(self):
+        # Every media item starts with exactly one id lookup
+        lookups = self.stats["id_lookups"]
+        return (self.stats["id_hits"] + self.stats["content_hits"]) / lookups if lookups else 0.0
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+def create_media_cache():
+    """Build the media analysis cache, or None when MEDIA_CACHE=0"""
+    if os.getenv("MEDIA_CACHE", "1") != "1":
+        return None
+    return MediaAnalysisCache(
+        os.getenv("MEDIA_CACHE_DB_PATH", "media_cache.db"),
+        ttl=float(os.getenv("MEDIA_CACHE_TTL", str(7 * 24 * 3600))),
+        max_entries=int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "10000"))
+    )
+
+async def lookup_media_analysis(key):
+    return await media_cache.get(key) if media_cache else None
+
+async def store_media_analysis(keys, response):
+    if media_cache:
+        await media_cache.put(keys, response)
+
+def file_sha256(path):
+    """Hex SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Görsel ön işleme ayarları
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+IMAGE_PREPROCESS_TIMEOUT = float(os.getenv("IMAGE_PREPROCESS_TIMEOUT", "20"))
+
+image_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0, "preprocess_seconds": 0.0, "gemini_seconds": 0.0}
+_image_pool = None
+
+def get_image_pool():
+    """Process pool used for CPU-bound image work; post_init creates it at startup.
+
+    Workers are started from a forkserver (or spawned), so they never fork a
+    copy of the running event loop, its threads and its sockets.
+    """
+    global _image_pool
+    if _image_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _image_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_PREPROCESS_WORKERS,
+            mp_context=multiprocessing.get_context(start_method)
+        )
+    return _image_pool
+
+def shutdown_image_pool(kill_workers=False):
+    """Drop the image pool; the next image starts a fresh one.
+
+    shutdown() cannot stop a worker that is already running a task, so a
+    stuck worker is only ended with kill_workers.
+    """
+    global _image_pool
+    if _image_pool is None:
+        return
+    pool, _image_pool = _image_pool, None
+    # shutdown() forgets the worker processes, so take them first
+    workers = list((pool._processes or {}).values()) if kill_workers else []
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in workers:
+        process.kill()
+
+def select_photo_size(photos, max_dimension):
+    """Pick the smallest PhotoSize that still covers max_dimension, or the largest one"""
+    covering = [p for p in photos if max(p.width, p.height) >= max_dimension]
+    if covering:
+        return min(covering, key=lambda p: p.width * p.height)
+    return max(photos, key=lambda p: p.width * p.height)
+
+def preprocess_image(data, max_dimension, quality):
+    """Downscale and recompress an image; returns (bytes, mime_type, sha256 of the input). Runs in a worker process."""
+    # Pillow is only needed in the image workers, so the bot process does not import it
+    from PIL import Image
+    # The cache key is the exact input: similar-looking images (e.g. memes on one template) must not share answers
+    content_hash = hashlib.sha256(data).hexdigest()
+    with Image.open(io.BytesIO(data)) as image:
+        source_format = image.format
+        source_mime = Image.MIME.get(source_format, "image/jpeg")
+        source_size = image.size
+        # JPEG draft mode decodes directly at a reduced scale, far cheaper than a full decode
+        image.draft("RGB", (max_dimension, max_dimension))
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        output = io.BytesIO()
+        if has_alpha:
+            image.save(output, format="WEBP", quality=quality)
+            mime_type = "image/webp"
+        else:
+            image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+            mime_type = "image/jpeg"
+    result = output.getvalue()
+    # Keep the original when it was already small enough and recompressing did not help
+    if max(source_size) <= max_dimension and len(result) >= len(data):
+        return data, source_mime, content_hash
+    return result, mime_type, content_hash
+
+async def prepare_image(data):
+    """Run preprocess_image off the event loop; returns (bytes, mime_type, sha256 of the original).
+
+    Falls back to the raw bytes when preprocessing fails.
+    """
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try:
+        # A stuck worker must not hang the handler, which holds the user's lock
+        processed, mime_type, content_hash = await asyncio.wait_for(
+            loop.run_in_executor(get_image_pool(), preprocess_image, data, IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY),
+            IMAGE_PREPROCESS_TIMEOUT
+        )
+    except Exception as e:
+        from concurrent.futures.process import BrokenProcessPool
+        logger.warning(f"Image preprocessing failed, sending original: {e!r}")
+        if isinstance(e, asyncio.TimeoutError):
+            # The worker is stuck and would keep its slot forever; kill it and start a fresh pool
+            shutdown_image_pool(kill_workers=True)
+        elif isinstance(e, BrokenProcessPool):
+            # A worker died; start a fresh pool for the next image
+            shutdown_image_pool()
+        processed, mime_type = data, "image/jpeg"
+        content_hash = hashlib.sha256(data).hexdigest()
+    elapsed = time.monotonic() - started
+    image_stats["images"] += 1
+    image_stats["bytes_in"] += len(data)
+    image_stats["bytes_out"] += len(processed)
+    image_stats["preprocess_seconds"] += elapsed
+    metrics.inc("nyxie_images_total")
+    metrics.observe("nyxie_image_preprocess_seconds", elapsed)
+    metrics.inc("nyxie_media_bytes_total", len(data), kind="image", stage="downloaded")
+    metrics.inc("nyxie_media_bytes_total", len(processed), kind="image", stage="uploaded")
+    return processed, mime_type, content_hash
 
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     
     try:
-        # Enhanced logging for debugging
-        logger.info(f"Starting image processing for user {user_id}")
-        
         # Validate message and photo
         if not update.message:
             logger.warning("No message found in update")
-            await update.message.reply_text("⚠️ Görsel bulunamadı. Lütfen tekrar deneyin.")
+            await send_reply(update, "⚠️ Görsel bulunamadı. Lütfen tekrar deneyin.")
             return
         
         # Get user's current language settings from memory
-        user_settings = user_memory.get_user_settings(user_id)
+        with stage_span("memory_load"):
+            await user_memory.ensure_loaded(user_id)
+            user_settings = user_memory.get_user_settings(user_id)
         user_lang = user_settings.get('language', 'tr')  # Default to Turkish if not set
-        logger.info(f"User language: {user_lang}")
         
         # Check if photo exists
         if not update.message.photo:
             logger.warning("No photo found in the message")
-            await update.message.reply_text("⚠️ Görsel bulunamadı. Lütfen tekrar deneyin.")
+            await send_reply(update, "⚠️ Görsel bulunamadı. Lütfen tekrar deneyin.")
             return
         
-        # Get the largest available photo
+        # Get the smallest photo size that is still large enough for analysis
         try:
-            photo = max(update.message.photo, key=lambda x: x.file_size)
+            photo = select_photo_size(update.message.photo, IMAGE_MAX_DIMENSION)
         except Exception as photo_error:
+            set_turn_outcome("error")
             logger.error(f"Error selecting photo: {photo_error}")
-            await update.message.reply_text("⚠️ Görsel seçiminde hata oluştu. Lütfen tekrar deneyin.")
-            return
-        
-        # Download photo
-        try:
-            photo_file = await context.bot.get_file(photo.file_id)
-            photo_bytes = bytes(await photo_file.download_as_bytearray())
-        except Exception as download_error:
-            logger.error(f"Photo download error: {download_error}")
-            await update.message.reply_text("⚠️ Görsel indirilemedi. Lütfen tekrar deneyin.")
+            await send_reply(update, "⚠️ Görsel seçiminde hata oluştu. Lütfen tekrar deneyin.")
             return
         
-        logger.info(f"Photo bytes downloaded: {len(photo_bytes)} bytes")
-        
-        # Comprehensive caption handling with extensive logging
+        # Caption handling
         caption = update.message.caption
-        logger.info(f"Original caption: {caption}")
-        
         default_prompt = get_analysis_prompt('image', None, user_lang)
-        logger.info(f"Default prompt: {default_prompt}")
         
         # Ensure caption is not None
         if caption is None:
@@ -565,111 +2766,311 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Ensure caption is a string and stripped
         caption = str(caption).strip()
-        logger.info(f"Final processed caption: {caption}")
-        
-        # Create a context-aware prompt that includes language preference
-        personality_context = get_time_aware_personality(
-            datetime.now(), 
-            user_lang,
-            user_settings.get('timezone', 'Europe/Istanbul')
-        )
         
-        if not personality_context:
-            personality_context = "Sen Nyxie'sin ve resimleri analiz ediyorsun."  # Fallback personality
-        
-        # Force Turkish analysis for all users
-        analysis_prompt = f"""DİKKAT: BU ANALİZİ TAMAMEN TÜRKÇE YAPACAKSIN!
-SADECE TÜRKÇE KULLAN! KESİNLİKLE BAŞKA DİL KULLANMA!
-
-{personality_context}
-
-Görevin: Bu resmi Türkçe olarak analiz et ve açıkla.
-Rol: Sen Nyxie'sin ve bu resmi Türkçe açıklıyorsun.
-
-Yönergeler:
-1. SADECE TÜRKÇE KULLAN
-2. Görseldeki metinleri orijinal dilinde bırak
-3. Doğal ve samimi bir dil kullan
-4. Kültürel bağlama uygun ol
-
-Lütfen analiz et:
-- Ana öğeler ve konular
-- Aktiviteler ve eylemler
-- Atmosfer ve ruh hali
-- Görünür metinler (orijinal dilinde)
-
-Kullanıcının sorusu: {caption}"""
+        # The static prefix is the model's system instruction; only the time block and caption are sent
+        with stage_span("prompt_build"):
+            analysis_prompt = build_request_prompt('image', user_settings.get('timezone', 'Europe/Istanbul'), caption)
         
         try:
-            # Prepare the message with both text and image
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
-            response = model.generate_content([
-                analysis_prompt, 
-                {"mime_type": "image/jpeg", "data": photo_bytes}
-            ])
+            # Forwarded images are often analysed already; check before downloading anything
+            id_key = MediaAnalysisCache.key('image', 'id', photo.file_unique_id, user_lang, caption)
+            with stage_span("cache_lookup"):
+                response_text = await lookup_media_analysis(id_key)
             
-            response_text = response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
+            if response_text is None:
+                # Download photo
+                try:
+                    with stage_span("download"):
+                        photo_file = await context.bot.get_file(photo.file_id)
+                        photo_bytes = bytes(await photo_file.download_as_bytearray())
+                except Exception as download_error:
+                    set_turn_outcome("error")
+                    logger.error(f"Photo download error: {download_error}")
+                    await send_reply(update, "⚠️ Görsel indirilemedi. Lütfen tekrar deneyin.")
+                    return
+                
+                with stage_span("preprocess"):
+                    photo_bytes, photo_mime, content_hash = await prepare_image(photo_bytes)
+                content_key = MediaAnalysisCache.key('image', 'sha256', content_hash, user_lang, caption)
+                with stage_span("cache_lookup"):
+                    response_text = await lookup_media_analysis(content_key)
+                
+                if response_text is not None:
+                    # Same picture under a new file id: remember the id too
+                    await store_media_analysis([id_key], response_text)
+                else:
+                    # Prepare the message with both text and image
+                    gemini_started = time.monotonic()
+                    with stage_span("gemini"):
+                        response = await call_gemini('image', user_lang, [
+                            analysis_prompt, 
+                            {"mime_type": photo_mime, "data": photo_bytes}
+                        ])
+                    gemini_seconds = time.monotonic() - gemini_started
+                    image_stats["gemini_seconds"] += gemini_seconds
+                    metrics.observe("nyxie_image_gemini_seconds", gemini_seconds)
+                    
+                    response_text = extract_response_text(response)
+                    await store_media_analysis([id_key, content_key], response_text)
             
             # Add culturally appropriate emojis
             response_text = add_random_emojis(response_text)
             
             # Save the interaction
-            user_memory.add_message(user_id, "user", f"[Image] {caption}")
-            user_memory.add_message(user_id, "assistant", response_text)
+            with stage_span("save"):
+                user_memory.add_message(user_id, "user", f"[Image] {caption}")
+                user_memory.add_message(user_id, "assistant", response_text)
             
             # Uzun mesajları böl ve gönder
-            await split_and_send_message(update, response_text)
+            with stage_span("send"):
+                await split_and_send_message(update, response_text)
         
         except Exception as processing_error:
+            set_turn_outcome("error")
             logger.error(f"Görsel işleme hatası: {processing_error}", exc_info=True)
             error_message = "Üzgünüm, bu görseli işlerken bir sorun oluştu. Lütfen tekrar dener misin? 🙏"
-            await update.message.reply_text(error_message)
+            await send_reply(update, error_message)
     
     except Exception as critical_error:
+        set_turn_outcome("error")
         logger.error(f"Kritik görsel işleme hatası: {critical_error}", exc_info=True)
-        await update.message.reply_text("Üzgünüm, görseli işlerken kritik bir hata oluştu. Lütfen tekrar deneyin.")
+        await send_reply(update, "Üzgünüm, görseli işlerken kritik bir hata oluştu. Lütfen tekrar deneyin.")
+
+# Video işleme ayarları
+VIDEO_MAX_BYTES = int(os.getenv("VIDEO_MAX_BYTES", str(20 * 1024 * 1024)))
+VIDEO_MAX_DURATION = int(os.getenv("VIDEO_MAX_DURATION", "300"))
+VIDEO_MAX_IN_FLIGHT = int(os.getenv("VIDEO_MAX_IN_FLIGHT", "2"))
+VIDEO_SPOOL_DIR = os.getenv("VIDEO_SPOOL_DIR") or None
+VIDEO_FILE_API = os.getenv("VIDEO_FILE_API", "1") == "1"
+VIDEO_UPLOAD_TIMEOUT = float(os.getenv("VIDEO_UPLOAD_TIMEOUT", "120"))
+VIDEO_UPLOAD_POLL_INTERVAL = 2.0
+
+# Caps how many videos are downloaded, uploaded and analysed at the same time
+video_semaphore = asyncio.Semaphore(VIDEO_MAX_IN_FLIGHT)
+
+def check_video_limits(video):
+    """Return a user-facing rejection message when a video is too large or too long, else None"""
+    if video.file_size and video.file_size > VIDEO_MAX_BYTES:
+        return f"⚠️ Video çok büyük ({video.file_size // (1024 * 1024)} MB). En fazla {VIDEO_MAX_BYTES // (1024 * 1024)} MB gönderebilirsin."
+    if video.duration and video.duration > VIDEO_MAX_DURATION:
+        return f"⚠️ Video çok uzun ({video.duration} sn). En fazla {VIDEO_MAX_DURATION} saniyelik videoları işleyebiliyorum."
+    return None
+
+@asynccontextmanager
+async def spooled_video(bot, video):
+    """Stream a Telegram video to a temp file and remove it afterwards"""
+    suffix = Path(video.file_name or "").suffix or ".mp4"
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix="video_", dir=VIDEO_SPOOL_DIR)
+    os.close(fd)
+    try:
+        with stage_span("download"):
+            video_file = await bot.get_file(video.file_id)
+            await video_file.download_to_drive(path)
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Could not remove spooled video {path}: {e}")
+
+async def wait_for_active_file(uploaded):
+    """Poll the File API until an uploaded file has been processed"""
+    deadline = time.monotonic() + VIDEO_UPLOAD_TIMEOUT
+    while uploaded.state.name == "PROCESSING":
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"File {uploaded.name} still processing after {VIDEO_UPLOAD_TIMEOUT}s")
+        await asyncio.sleep(VIDEO_UPLOAD_POLL_INTERVAL)
+        uploaded = await asyncio.to_thread(genai.get_file, uploaded.name)
+    if uploaded.state.name != "ACTIVE":
+        raise RuntimeError(f"File {uploaded.name} failed processing: {uploaded.state.name}")
+    return uploaded
+
+@asynccontextmanager
+async def video_content_part(path, mime_type):
+    """Yield a content part for a spooled video: a File API reference, or inline bytes as fallback"""
+    uploaded = None
+    if VIDEO_FILE_API:
+        try:
+            started = time.monotonic()
+            with stage_span("upload"):
+                uploaded = await asyncio.to_thread(genai.upload_file, path, mime_type=mime_type)
+                uploaded = await wait_for_active_file(uploaded)
+            logger.info(f"Video uploaded via File API as {uploaded.name} in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            logger.warning(f"File API upload failed, sending video inline: {e}")
+            if uploaded is not None:
+                await asyncio.to_thread(genai.delete_file, uploaded.name)
+            uploaded = None
+    try:
+        if uploaded is not None:
+            yield uploaded
+        else:
+            # Read straight from disk so only one copy of the video is held in memory
+            yield {"mime_type": mime_type, "data": await asyncio.to_thread(Path(path).read_bytes)}
+    finally:
+        if uploaded is not None:
+            try:
+                await asyncio.to_thread(genai.delete_file, uploaded.name)
+            except Exception as e:
+                logger.warning(f"Could not delete uploaded file {uploaded.name}: {e}")
+
+# Keyframe mode: send sampled frames (and optionally a transcript) instead of the whole video
+VIDEO_MODE = os.getenv("VIDEO_MODE", "full")
+VIDEO_KEYFRAMES = int(os.getenv("VIDEO_KEYFRAMES", "8"))
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", "16"))
+VIDEO_SCENE_THRESHOLD = float(os.getenv("VIDEO_SCENE_THRESHOLD", "0.3"))
+VIDEO_FRAME_DIMENSION = int(os.getenv("VIDEO_FRAME_DIMENSION", "768"))
+VIDEO_FRAME_QSCALE = int(os.getenv("VIDEO_FRAME_QSCALE", "5"))
+VIDEO_TRANSCRIBE_AUDIO = os.getenv("VIDEO_TRANSCRIBE_AUDIO", "0") == "1"
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", "120"))
+VIDEO_SCENE_MIN_GAP = 0.5
+
+# Hareket veya ses soran açıklamalar karelerle cevaplanamaz; bunlarda videonun tamamı gönderilir.
+# Türkçe kökler eklerle kullanılır; İngilizce kelimeler ise tam eşleşir ('heart', 'single', 'session' eşleşmez)
+FULL_VIDEO_CAPTION_RE = re.compile(
+    r"\b(?:hareket|hızl|hız\b|dans|ses(?:[ilt]\w*|s[iı]z\w*|e\w*)?\b|müzik|şarkı|konuş|söyl|dinle)|"
+    r"\b(?:motion|moving|moves?|speed(?:s|ing)?|danc(?:e|es|ed|ing|ers?)|sounds?|audio|music(?:al)?|songs?|"
+    r"sing(?:s|ing|ers?)?|say(?:s|ing)?|said|speak(?:s|ing|ers?)?|spoken?|talk(?:s|ed|ing)?|hear(?:s|d|ing)?|"
+    r"listen(?:s|ed|ing)?)\b",
+    re.IGNORECASE
+)
+
+TRANSCRIBE_PROMPT = """Transcribe the speech in this audio verbatim, in its original language.
+Note important non-speech sounds briefly in square brackets.
+If there is no speech, describe the sounds in one line."""
+
+def needs_full_video(caption):
+    """True when the user's caption asks about motion or sound"""
+    return bool(caption and FULL_VIDEO_CAPTION_RE.search(caption))
+
+def keyframe_filter(duration, count, threshold, max_dimension):
+    """ffmpeg filter selecting evenly spaced frames plus scene changes, scaled down"""
+    interval = max((duration or 10) / max(count, 1), VIDEO_SCENE_MIN_GAP)
+    select = (
+        f"isnan(prev_selected_t)+gte(t-prev_selected_t,{interval:.3f})"
+        f"+gt(scene,{threshold})*gte(t-prev_selected_t,{VIDEO_SCENE_MIN_GAP})"
+    )
+    return f"select='{select}',scale={max_dimension}:{max_dimension}:force_original_aspect_ratio=decrease"
+
+def evenly_spaced(items, limit):
+    """Keep at most `limit` items spread over the whole list, first and last included"""
+    if len(items) <= limit:
+        return items
+    if limit <= 1:
+        return items[:limit]
+    return [items[round(i * (len(items) - 1) / (limit - 1))] for i in range(limit)]
+
+async def run_ffmpeg(*args):
+    """Run ffmpeg without blocking the loop; raises RuntimeError on failure"""
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-nostdin", "-y", *args,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), FFMPEG_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise RuntimeError(f"ffmpeg timed out after {FFMPEG_TIMEOUT}s")
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()[-500:]}")
+
+async def extract_keyframes(path, duration):
+    """JPEG bytes of the sampled frames, in playback order"""
+    with tempfile.TemporaryDirectory(prefix="frames_", dir=VIDEO_SPOOL_DIR) as frame_dir:
+        await run_ffmpeg(
+            "-i", path, "-an",
+            "-vf", keyframe_filter(duration, VIDEO_KEYFRAMES, VIDEO_SCENE_THRESHOLD, VIDEO_FRAME_DIMENSION),
+            "-vsync", "vfr", "-q:v", str(VIDEO_FRAME_QSCALE),
+            os.path.join(frame_dir, "frame_%05d.jpg")
+        )
+        frame_paths = sorted(Path(frame_dir).glob("frame_*.jpg"))
+        return [await asyncio.to_thread(p.read_bytes) for p in evenly_spaced(frame_paths, VIDEO_MAX_FRAMES)]
+
+async def extract_audio(path):
+    """Mono low-bitrate AAC of the audio track, or None when the video has no audio"""
+    audio_path = f"{path}.aac"
+    try:
+        await run_ffmpeg("-i", path, "-vn", "-ac", "1", "-ar", "16000", "-c:a", "aac", "-b:a", "32k", audio_path)
+        return await asyncio.to_thread(Path(audio_path).read_bytes)
+    except RuntimeError as e:
+        logger.info(f"No audio extracted from {path}: {e}")
+        return None
+    finally:
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+
+async def transcribe_audio(audio_bytes):
+    response = await call_gemini('transcribe', None, [
+        TRANSCRIBE_PROMPT,
+        {"mime_type": "audio/aac", "data": audio_bytes}
+    ])
+    return extract_response_text(response).strip()
+
+async def build_keyframe_parts(path, duration):
+    """Content parts for keyframe mode: the sampled frames and, if enabled, an audio transcript"""
+    started = time.monotonic()
+    frames, audio = await asyncio.gather(
+        extract_keyframes(path, duration),
+        extract_audio(path) if VIDEO_TRANSCRIBE_AUDIO else asyncio.sleep(0)
+    )
+    if not frames:
+        raise RuntimeError("ffmpeg produced no frames")
+    parts = [f"[Videodan sırayla alınmış {len(frames)} kare]"]
+    parts.extend({"mime_type": "image/jpeg", "data": frame} for frame in frames)
+    if audio:
+        try:
+            parts.append(f"[Videonun ses dökümü]\n{await transcribe_audio(audio)}")
+        except Exception as e:
+            logger.warning(f"Audio transcription failed, continuing with frames only: {e}")
+    frame_bytes = sum(len(frame) for frame in frames)
+    logger.info(
+        f"Keyframes extracted: {len(frames)} frames, {frame_bytes} bytes"
+        f"{f', audio {len(audio)} bytes' if audio else ''} in {time.monotonic() - started:.1f}s"
+    )
+    return parts
 
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     
     try:
-        # Enhanced logging for debugging
-        logger.info(f"Starting video processing for user {user_id}")
-        
         # Validate message and video
         if not update.message:
             logger.warning("No message found in update")
-            await update.message.reply_text("⚠️ Video bulunamadı. Lütfen tekrar deneyin.")
+            await send_reply(update, "⚠️ Video bulunamadı. Lütfen tekrar deneyin.")
             return
         
         # Get user's current language settings from memory
-        user_settings = user_memory.get_user_settings(user_id)
+        with stage_span("memory_load"):
+            await user_memory.ensure_loaded(user_id)
+            user_settings = user_memory.get_user_settings(user_id)
         user_lang = user_settings.get('language', 'tr')  # Default to Turkish if not set
-        logger.info(f"User language: {user_lang}")
         
         # Check if video exists
         if not update.message.video:
             logger.warning("No video found in the message")
-            await update.message.reply_text("⚠️ Video bulunamadı. Lütfen tekrar deneyin.")
+            await send_reply(update, "⚠️ Video bulunamadı. Lütfen tekrar deneyin.")
             return
         
         # Get the video file
         video = update.message.video
         if not video:
             logger.warning("No video found in the message")
-            await update.message.reply_text("⚠️ Video bulunamadı. Lütfen tekrar deneyin.")
+            await send_reply(update, "⚠️ Video bulunamadı. Lütfen tekrar deneyin.")
             return
-            
-        video_file = await context.bot.get_file(video.file_id)
-        video_bytes = bytes(await video_file.download_as_bytearray())
-        logger.info(f"Video bytes downloaded: {len(video_bytes)} bytes")
         
-        # Comprehensive caption handling with extensive logging
-        caption = update.message.caption
-        logger.info(f"Original caption: {caption}")
+        # Reject oversized videos before downloading anything
+        rejection = check_video_limits(video)
+        if rejection:
+            set_turn_outcome("rejected")
+            logger.info(f"Video rejected: {video.file_size} bytes, {video.duration}s")
+            await send_reply(update, rejection)
+            return
         
+        # Caption handling
+        caption = update.message.caption
         default_prompt = get_analysis_prompt('video', None, user_lang)
-        logger.info(f"Default prompt: {default_prompt}")
         
         # Ensure caption is not None
         if caption is None:
@@ -677,111 +3078,365 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Ensure caption is a string and stripped
         caption = str(caption).strip()
-        logger.info(f"Final processed caption: {caption}")
-        
-        # Create a context-aware prompt that includes language preference
-        personality_context = get_time_aware_personality(
-            datetime.now(), 
-            user_lang,
-            user_settings.get('timezone', 'Europe/Istanbul')
-        )
         
-        if not personality_context:
-            personality_context = "Sen Nyxie'sin ve videoları analiz ediyorsun."  # Fallback personality
-        
-        # Force Turkish analysis for all users
-        analysis_prompt = f"""DİKKAT: BU ANALİZİ TAMAMEN TÜRKÇE YAPACAKSIN!
-SADECE TÜRKÇE KULLAN! KESİNLİKLE BAŞKA DİL KULLANMA!
-
-{personality_context}
-
-Görevin: Bu videoyu Türkçe olarak analiz et ve açıkla.
-Rol: Sen Nyxie'sin ve bu videoyu Türkçe açıklıyorsun.
-
-Yönergeler:
-1. SADECE TÜRKÇE KULLAN
-2. Videodaki konuşma/metinleri orijinal dilinde bırak
-3. Doğal ve samimi bir dil kullan
-4. Kültürel bağlama uygun ol
-
-Lütfen analiz et:
-- Ana olaylar ve eylemler
-- İnsanlar ve nesneler
-- Sesler ve konuşmalar
-- Atmosfer ve ruh hali
-- Görünür metinler (orijinal dilinde)
-
-Kullanıcının sorusu: {caption}"""
+        # The static prefix is the model's system instruction; only the time block and caption are sent
+        with stage_span("prompt_build"):
+            analysis_prompt = build_request_prompt('video', user_settings.get('timezone', 'Europe/Istanbul'), caption)
         
         try:
-            # Prepare the message with both text and video
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
-            response = model.generate_content([
-                analysis_prompt,
-                {"mime_type": "video/mp4", "data": video_bytes}
-            ])
+            # Viral videos get forwarded over and over; check before downloading anything
+            id_key = MediaAnalysisCache.key('video', 'id', video.file_unique_id, user_lang, caption)
+            with stage_span("cache_lookup"):
+                response_text = await lookup_media_analysis(id_key)
             
-            response_text = response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
+            if response_text is None:
+                with stage_span("queue"):
+                    await video_semaphore.acquire()
+                try:
+                    async with spooled_video(context.bot, video) as video_path:
+                        metrics.inc("nyxie_media_bytes_total", os.path.getsize(video_path), kind="video", stage="downloaded")
+                        with stage_span("cache_lookup"):
+                            content_hash = await asyncio.to_thread(file_sha256, video_path)
+                            content_key = MediaAnalysisCache.key('video', 'sha256', content_hash, user_lang, caption)
+                            response_text = await lookup_media_analysis(content_key)
+                        if response_text is not None:
+                            # Same video under a new file id: remember the id too
+                            await store_media_analysis([id_key], response_text)
+                        else:
+                            keyframe_parts = None
+                            if VIDEO_MODE == "keyframes" and not needs_full_video(update.message.caption):
+                                try:
+                                    with stage_span("preprocess"):
+                                        keyframe_parts = await build_keyframe_parts(video_path, video.duration)
+                                except Exception as e:
+                                    logger.warning(f"Keyframe sampling failed, sending the full video: {e}")
+                            if keyframe_parts:
+                                with stage_span("gemini"):
+                                    response = await call_gemini('video', user_lang, [analysis_prompt, *keyframe_parts])
+                            else:
+                                async with video_content_part(video_path, video.mime_type or "video/mp4") as video_part:
+                                    # Prepare the message with both text and video
+                                    with stage_span("gemini"):
+                                        response = await call_gemini('video', user_lang, [analysis_prompt, video_part])
+                            response_text = extract_response_text(response)
+                            await store_media_analysis([id_key, content_key], response_text)
+                finally:
+                    video_semaphore.release()
             
             # Add culturally appropriate emojis
             response_text = add_random_emojis(response_text)
             
             # Save the interaction
-            user_memory.add_message(user_id, "user", f"[Video] {caption}")
-            user_memory.add_message(user_id, "assistant", response_text)
+            with stage_span("save"):
+                user_memory.add_message(user_id, "user", f"[Video] {caption}")
+                user_memory.add_message(user_id, "assistant", response_text)
             
             # Uzun mesajları böl ve gönder
-            await split_and_send_message(update, response_text)
+            with stage_span("send"):
+                await split_and_send_message(update, response_text)
         
         except Exception as processing_error:
+            set_turn_outcome("error")
             logger.error(f"Video processing error: {processing_error}", exc_info=True)
             
             if "Token limit exceeded" in str(processing_error):
-                logger.warning(f"Token limit exceeded for user {user_id}, removing oldest messages")
-                try:
-                    if user_memory.users[user_id]["messages"]:
-                        user_memory.users[user_id]["messages"].pop(0)
-                        model = genai.GenerativeModel('gemini-2.0-flash-exp')
-                        response = model.generate_content([
-                            analysis_prompt,
-                            {"mime_type": "video/mp4", "data": video_bytes}
-                        ])
-                        response_text = response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
-                        response_text = add_random_emojis(response_text)
-                        await update.message.reply_text(response_text)
-                    else:
-                        await update.message.reply_text("⚠️ Üzgünüm, videonuzu işlerken hafıza sınırına ulaştım. Lütfen tekrar deneyin.")
-                except Exception as retry_error:
-                    logger.error(f"Retry error: {retry_error}", exc_info=True)
-                    await update.message.reply_text("⚠️ Üzgünüm, videonuzu işlerken bir hata oluştu. Lütfen tekrar deneyin.")
+                # Retrying the same video cannot fit it into the limit
+                await handle_token_limit_error(update)
             else:
                 # Generic error handling
-                await update.message.reply_text("⚠️ Üzgünüm, videonuzu işlerken bir hata oluştu. Lütfen tekrar deneyin.")
+                await send_reply(update, "⚠️ Üzgünüm, videonuzu işlerken bir hata oluştu. Lütfen tekrar deneyin.")
     
     except Exception as e:
+        set_turn_outcome("error")
         logger.error(f"Kritik video işleme hatası: {e}", exc_info=True)
-        await update.message.reply_text("⚠️ Üzgünüm, videonuzu işlerken kritik bir hata oluştu. Lütfen tekrar deneyin.")
+        await send_reply(update, "⚠️ Üzgünüm, videonuzu işlerken kritik bir hata oluştu. Lütfen tekrar deneyin.")
+
+class UserLocks:
+    """One asyncio.Lock per user, dropped again once nobody holds or waits for it.
+
+    asyncio.Lock wakes waiters in FIFO order, so a user's updates are handled
+    in the order they arrived while different users run in parallel.
+    """
+
+    def __init__(self):
+        self.locks = {}
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        entry = self.locks.get(user_id)
+        if entry is None:
+            entry = self.locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[user_id]
+
+user_locks = UserLocks()
+
+def serialize_per_user(handler):
+    """Wrap a handler so updates from the same user never run concurrently"""
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        user = update.effective_user if update else None
+        if user is None:
+            return await handler(update, context, *args, **kwargs)
+        async with user_locks.hold(user.id):
+            return await handler(update, context, *args, **kwargs)
+    return wrapper
+
+class MessageCoalescer:
+    """Merges a user's rapid-fire text messages into a single generation.
+
+    The first message of a burst waits until no new message from the same user
+    has arrived for `window` seconds, or until `max_batch` messages are
+    collected. The texts are then joined and answered once, replying to the
+    last message of the burst. Later messages only join the batch and return
+    immediately.
+
+    The batch takes the user's lock when it opens, so a photo or video sent
+    during the burst is answered after it, in arrival order.
+    """
+
+    def __init__(self, handler, window, max_batch=5):
+        # handler(update, context, message_text); the coalescer serializes it per user
+        self.handler = handler
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}
+        self.stats = {"messages": 0, "batches": 0, "calls_saved": 0}
+
+    async def submit(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not update or not update.message or not update.message.text or not update.effective_user:
+            return await self.handler(update, context, None)
+        user_id = update.effective_user.id
+        self.stats["messages"] += 1
+        metrics.inc("nyxie_coalescer_messages_total")
+        batch = self.pending.get(user_id)
+        if batch is not None and len(batch["texts"]) < self.max_batch:
+            batch["texts"].append(update.message.text)
+            batch["update"] = update
+            batch["arrived"].set()
+            return
+
+        batch = {"texts": [update.message.text], "update": update, "arrived": asyncio.Event()}
+        self.pending[user_id] = batch
+        # Queue for the user's lock right away, ahead of anything sent after this message;
+        # texts that arrive while an earlier update is still being answered join the batch
+        async with user_locks.hold(user_id):
+            try:
+                while len(batch["texts"]) < self.max_batch:
+                    batch["arrived"].clear()
+                    try:
+                        await asyncio.wait_for(batch["arrived"].wait(), self.window)
+                    except asyncio.TimeoutError:
+                        break
+            finally:
+                if self.pending.get(user_id) is batch:
+                    del self.pending[user_id]
+
+            self.stats["batches"] += 1
+            self.stats["calls_saved"] += len(batch["texts"]) - 1
+            metrics.inc("nyxie_coalescer_batches_total")
+            metrics.inc("nyxie_coalescer_calls_saved_total", len(batch["texts"]) - 1)
+            if len(batch["texts"]) > 1:
+                logger.info(f"Coalesced {len(batch['texts'])} messages from user {user_id}")
+            await self.handler(batch["update"], context, "\n".join(batch["texts"]))
 
 async def handle_token_limit_error(update: Update):
     error_message = "Üzgünüm, mesaj geçmişi çok uzun olduğu için yanıt veremedim. Biraz bekleyip tekrar dener misin? 🙏"
-    await update.message.reply_text(error_message)
+    await send_reply(update, error_message)
 
 async def handle_memory_error(update: Update):
     error_message = "Üzgünüm, bellek sınırına ulaşıldı. Lütfen biraz bekleyip tekrar dener misin? 🙏"
-    await update.message.reply_text(error_message)
+    await send_reply(update, error_message)
+
+async def post_init(application: Application):
+    metrics_port = int(os.getenv("METRICS_PORT", "9108"))
+    if metrics_port:
+        metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+        metrics.register_gauge("nyxie_outbound_queue_depth", lambda: outbound_sender.queue_depth)
+        metrics.register_gauge("nyxie_memory_cached_users", lambda: len(user_memory.users))
+        metrics.register_gauge("nyxie_gemini_breaker_open", lambda: int(gemini_caller.breaker.state == "open"))
+        if media_cache:
+            metrics.register_gauge("nyxie_media_cache_hit_ratio", lambda: media_cache.hit_ratio)
+        try:
+            application.bot_data["metrics_server"] = await serve_metrics(metrics_host, metrics_port)
+            logger.info(f"Metrics available at http://{metrics_host}:{metrics_port}/metrics")
+        except OSError as e:
+            logger.error(f"Could not start the metrics server on port {metrics_port}: {e}")
+    # Start the image workers now rather than on the first photo
+    get_image_pool()
+    if language_detector:
+        # Load the langdetect profiles before the first update instead of during it
+        await asyncio.to_thread(language_detector.preload)
+    # Start the write-behind flusher for user memories
+    application.bot_data["memory_flush_task"] = asyncio.create_task(user_memory.run_flush_loop())
+    if os.getenv("HISTORY_SUMMARIES", "1") == "1":
+        # Fold old history into per-user summaries while users are idle
+        compactor = create_history_compactor(user_memory)
+        application.bot_data["history_compactor"] = compactor
+        application.bot_data["history_compaction_task"] = asyncio.create_task(
+            compactor.run_loop(float(os.getenv("HISTORY_SUMMARY_CHECK_INTERVAL", "30")))
+        )
+
+async def post_shutdown(application: Application):
+    metrics_server = application.bot_data.pop("metrics_server", None)
+    if metrics_server:
+        metrics_server.close()
+    for task_name in ("memory_flush_task", "history_compaction_task"):
+        task = application.bot_data.pop(task_name, None)
+        if task:
+            task.cancel()
+    # Persist everything that is still pending
+    await user_memory.flush()
+    user_memory.storage.close()
+    logger.info(f"Memory flush stats: {user_memory.flush_stats}")
+    logger.info(f"Memory cache stats: {user_memory.users.stats}")
+    compactor = application.bot_data.get("history_compactor")
+    if compactor:
+        logger.info(f"History summary stats: {compactor.stats}")
+    logger.info(f"Outbound send stats: {outbound_sender.stats}")
+    logger.info(f"Image pipeline stats: {image_stats}")
+    if language_detector:
+        logger.info(f"Language detection stats: {language_detector.stats}")
+    if media_cache:
+        logger.info(f"Media cache stats: {media_cache.stats}, hit ratio {media_cache.hit_ratio:.1%}")
+        media_cache.close()
+    shutdown_image_pool()
+    message_coalescer = application.bot_data.get("message_coalescer")
+    if message_coalescer:
+        logger.info(f"Message coalescing stats: {message_coalescer.stats}")
+
+# Only messages have handlers; asking Telegram for nothing else keeps updates like
+# edited messages (where update.message is None) away from the handlers
+ALLOWED_UPDATES = [Update.MESSAGE]
 
 def main():
     # Initialize bot
-    application = Application.builder().token(os.getenv("TELEGRAM_TOKEN")).build()
+    # Process updates from different users concurrently so a slow generation for one user
+    # does not hold up the others; each user's own updates are serialized by serialize_per_user
+    builder = (
+        Application.builder()
+        .token(os.getenv("TELEGRAM_TOKEN"))
+        .concurrent_updates(int(os.getenv("CONCURRENT_UPDATES", "64")))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    api_base_url = os.getenv("TELEGRAM_API_BASE_URL")
+    if api_base_url:
+        # A local Bot API server, or the stand-in from tools/post_update.py --serve-api
+        api_base_url = api_base_url.rstrip("/")
+        builder = builder.base_url(f"{api_base_url}/bot").base_file_url(f"{api_base_url}/file/bot")
+    application = builder.build()
     
     # Add handlers
-    application.add_handler(MessageHandler(filters.VIDEO, handle_video))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_image))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.VIDEO, serialize_per_user(instrument_handler("video")(handle_video))))
+    application.add_handler(MessageHandler(filters.PHOTO, serialize_per_user(instrument_handler("image")(handle_image))))
+    coalesce_window_ms = int(os.getenv("MESSAGE_COALESCE_WINDOW_MS", "0"))
+    if coalesce_window_ms > 0:
+        # Answer bursts of short messages with one generation; the coalescer takes the user's lock itself
+        message_coalescer = MessageCoalescer(
+            instrument_handler("text")(handle_message),
+            coalesce_window_ms / 1000,
+            max_batch=int(os.getenv("MESSAGE_COALESCE_MAX_BATCH", "5"))
+        )
+        application.bot_data["message_coalescer"] = message_coalescer
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_coalescer.submit))
+    else:
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, serialize_per_user(instrument_handler("text")(handle_message))))
     
     # Start the bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if os.getenv("TELEGRAM_MODE", "polling").lower() == "webhook":
+        webhook_url = os.getenv("WEBHOOK_URL")
+        if not webhook_url:
+            raise SystemExit("WEBHOOK_URL is required when TELEGRAM_MODE=webhook")
+        url_path = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+        port = int(os.getenv("WEBHOOK_PORT", "8443"))
+        logger.info(f"Starting webhook server on port {port}, path /{url_path}")
+        application.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=port,
+            url_path=url_path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{url_path}",
+            secret_token=os.getenv("WEBHOOK_SECRET_TOKEN") or None,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+def profile_startup(top=15):
+    """Import bot.py in a fresh interpreter under -X importtime and report where the time goes.
+
+    Returns a non-zero exit code when the import takes longer than STARTUP_BUDGET_SECONDS.
+    """
+    budget = float(os.getenv("STARTUP_BUDGET_SECONDS", "3"))
+    bot_dir = os.path.dirname(os.path.abspath(__file__))
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {bot_dir!r}); import bot"],
+        capture_output=True, text=True
+    )
+    wall_seconds = time.perf_counter() - started
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        print("Importing bot.py failed")
+        return result.returncode
+
+    # Self time summed per top-level package, so each package is charged only for its own modules
+    self_by_package = {}
+    import_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        name = name.strip()
+        package = name.split(".")[0]
+        self_by_package[package] = self_by_package.get(package, 0) + int(self_us)
+        if name == "bot":
+            import_us = int(cumulative_us)
+
+    print(f"{'package':<40} {'self ms':>10} {'share':>7}")
+    for package, self_us in sorted(self_by_package.items(), key=lambda item: -item[1])[:top]:
+        print(f"{package:<40} {self_us / 1000:>10.1f} {self_us / max(import_us, 1):>7.1%}")
+    try:
+        import resource
+        print(f"peak RSS: {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f} MB")
+    except ImportError:
+        pass
+    import_seconds = import_us / 1e6
+    print(f"import bot: {import_seconds:.2f}s (interpreter total {wall_seconds:.2f}s), budget {budget:.2f}s")
+    if import_seconds > budget:
+        print("Startup budget exceeded")
+        return 1
+    return 0
 
 if __name__ == '__main__':
-    user_memory = UserMemory()
-    main()
+    parser = argparse.ArgumentParser(description="Nyxie Telegram bot")
+    parser.add_argument(
+        "--migrate-json-to-sqlite",
+        action="store_true",
+        help="import user_memories/*.json into the SQLite backend (MEMORY_DB_PATH) and exit"
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="report the import-time breakdown of bot.py and check it against STARTUP_BUDGET_SECONDS"
+    )
+    args = parser.parse_args()
+    if args.profile_startup:
+        sys.exit(profile_startup())
+    elif args.migrate_json_to_sqlite:
+        migrate_json_to_sqlite(
+            os.getenv("MEMORY_DIR", "user_memories"),
+            os.getenv("MEMORY_DB_PATH", "user_memories.db")
+        )
+    else:
+        user_memory = UserMemory()
+        model_registry = create_model_registry()
+        gemini_caller = create_gemini_caller()
+        media_cache = create_media_cache()
+        main()
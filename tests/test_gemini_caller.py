@@ -0,0 +1,179 @@
+import asyncio
+import os
+import sys
+import threading
+
+import google.generativeai as genai
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+import bot
+from bot import CircuitBreaker, CircuitOpenError, GeminiCaller
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+import fake_gemini_server  # noqa: E402
+
+REPLY = "Merhaba! Ben Nyxie, sahte sunucudan selamlar."
+REQUEST_OPTIONS = {"timeout": 5, "retry": None}
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    """Start a fake Gemini server; returns a function building (model, server stats) for given options"""
+    servers = []
+
+    def start(*args):
+        options = fake_gemini_server.parse_args(
+            ["--port", "0", "--latency", "0", "--jitter", "0", "--chunk-delay", "0", "--reply", REPLY, *args]
+        )
+        server = fake_gemini_server.create_server(options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        host, port = server.server_address
+        genai.configure(api_key="test", transport="rest", client_options={"api_endpoint": f"http://{host}:{port}"})
+        monkeypatch.setattr(bot, "GEMINI_TRANSPORT", "rest")
+        return genai.GenerativeModel("gemini-test"), server.RequestHandlerClass.stats
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_caller(failure_threshold=5, reset_timeout=30.0, max_attempts=3, slots=4, hedge_delay=None):
+    return GeminiCaller(
+        CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout),
+        max_attempts=max_attempts,
+        base_delay=0.01,
+        max_delay=0.05,
+        hedge_delay=hedge_delay,
+        semaphore=asyncio.Semaphore(slots)
+    )
+
+
+def test_retries_until_the_server_recovers(fake_gemini):
+    model, server_stats = fake_gemini("--fail-first", "2", "--error-codes", "503")
+
+    async def scenario():
+        caller = make_caller()
+        response = await caller.call(lambda: bot.generate_content_async(model, "selam", request_options=REQUEST_OPTIONS), 5)
+        return caller, response
+
+    caller, response = asyncio.run(scenario())
+    assert response.text == REPLY
+    assert caller.stats["retries"] == 2
+    assert server_stats["requests"] == 3
+    assert caller.breaker.state == "closed"
+
+
+def test_breaker_opens_and_fails_fast(fake_gemini):
+    model, server_stats = fake_gemini("--error-rate", "1", "--error-codes", "503")
+
+    async def scenario():
+        caller = make_caller(failure_threshold=2, max_attempts=2)
+        make_call = lambda: bot.generate_content_async(model, "selam", request_options=REQUEST_OPTIONS)
+        with pytest.raises(api_exceptions.ServiceUnavailable):
+            await caller.call(make_call, 5)
+        assert caller.breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await caller.call(make_call, 5)
+
+    asyncio.run(scenario())
+    assert server_stats["requests"] == 2
+
+
+def test_half_open_breaker_admits_a_single_trial(fake_gemini):
+    model, server_stats = fake_gemini("--fail-first", "2", "--error-codes", "503", "--latency", "0.2")
+
+    async def scenario():
+        caller = make_caller(failure_threshold=2, reset_timeout=0.1, max_attempts=2)
+        make_call = lambda: bot.generate_content_async(model, "selam", request_options=REQUEST_OPTIONS)
+        with pytest.raises(api_exceptions.ServiceUnavailable):
+            await caller.call(make_call, 5)
+        await asyncio.sleep(0.15)
+        assert caller.breaker.state == "half_open"
+        results = await asyncio.gather(*(caller.call(make_call, 5) for _ in range(3)), return_exceptions=True)
+        return caller, results
+
+    caller, results = asyncio.run(scenario())
+    assert sum(not isinstance(result, Exception) for result in results) == 1
+    assert sum(isinstance(result, CircuitOpenError) for result in results) == 2
+    assert server_stats["requests"] == 3
+    assert caller.breaker.state == "closed"
+
+
+def test_stream_over_rest(fake_gemini):
+    model, _ = fake_gemini("--fail-first", "1", "--error-codes", "503")
+
+    async def scenario():
+        caller = make_caller()
+        stream = caller.stream(lambda: bot.stream_content_async(model, "selam", request_options=REQUEST_OPTIONS), 5)
+        return caller, [chunk async for chunk in stream]
+
+    caller, chunks = asyncio.run(scenario())
+    assert "".join(chunks).strip() == REPLY
+    assert caller.stats["retries"] == 1
+
+
+def test_waiting_for_a_slot_is_not_a_failure():
+    async def slow():
+        await asyncio.sleep(0.3)
+        return "slow"
+
+    async def fast():
+        return "fast"
+
+    async def scenario():
+        caller = make_caller(slots=1)
+        busy = asyncio.ensure_future(caller.call(slow, 1))
+        await asyncio.sleep(0)
+        # Queued behind the slow call for longer than its own deadline
+        result = await caller.call(fast, 0.1)
+        await busy
+        return caller, result
+
+    caller, result = asyncio.run(scenario())
+    assert result == "fast"
+    assert caller.breaker.failures == 0
+    assert caller.stats["retries"] == 0
+
+
+@pytest.mark.parametrize("slots, hedged", [(1, False), (2, True)])
+def test_hedge_only_with_a_free_slot(slots, hedged):
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return "ok"
+
+    async def scenario():
+        caller = make_caller(slots=slots, hedge_delay=0.05)
+        return caller, await caller.call(slow, 1, hedge=True)
+
+    caller, result = asyncio.run(scenario())
+    assert result == "ok"
+    assert len(calls) == (2 if hedged else 1)
+    assert caller.stats["hedges"] == int(hedged)
+    assert caller.stats["hedges_skipped"] == int(not hedged)
+
+
+def test_stream_deadline_excludes_consumer_time():
+    async def chunks():
+        for text in ("bir ", "iki ", "üç"):
+            await asyncio.sleep(0.05)
+            yield text
+
+    async def scenario():
+        caller = make_caller()
+        received = []
+        async for chunk in caller.stream(chunks, 0.2):
+            received.append(chunk)
+            # A slow consumer, e.g. waiting out a Telegram RetryAfter
+            await asyncio.sleep(0.3)
+        return caller, received
+
+    caller, received = asyncio.run(scenario())
+    assert received == ["bir ", "iki ", "üç"]
+    assert caller.breaker.failures == 0
+    assert caller.stats["failures"] == 0
@@ -0,0 +1,37 @@
+import pytest
+
+from bot import needs_full_video
+
+
+@pytest.mark.parametrize("caption", [
+    "Bu videoda ne söyleniyor?",
+    "sesi ne kadar yüksek",
+    "arkadaki sesler ne",
+    "sessiz mi",
+    "hangi şarkı çalıyor",
+    "dans eden kim",
+    "what is she saying",
+    "can you hear it",
+    "who is singing",
+    "what did he say",
+    "how fast is it moving",
+    "listen to the song",
+    "what language is spoken",
+    "is the speaker angry",
+])
+def test_motion_or_sound_captions_need_the_full_video(caption):
+    assert needs_full_video(caption)
+
+
+@pytest.mark.parametrize("caption", [
+    "what is on the heart monitor",
+    "a single frame is enough",
+    "describe this session",
+    "who is the spokesperson",
+    "what color is the car",
+    "bu videoda kaç kişi var",
+    "",
+    None,
+])
+def test_other_captions_use_frames(caption):
+    assert not needs_full_video(caption)
@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import io
+import time
+
+from PIL import Image, ImageDraw
+
+import bot
+from bot import preprocess_image
+
+
+def meme(text):
+    """Same template, different caption: near-identical pixels"""
+    image = Image.new("RGB", (800, 600), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((100, 100, 700, 500), fill="navy")
+    draw.text((20, 560), text, fill="black")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def test_content_key_is_the_sha256_of_the_input():
+    first, second = meme("when the build is green"), meme("when the build is red")
+    _, _, first_key = preprocess_image(first, 512, 85)
+    _, _, second_key = preprocess_image(second, 512, 85)
+    assert first_key == hashlib.sha256(first).hexdigest()
+    assert second_key == hashlib.sha256(second).hexdigest()
+    assert first_key != second_key
+
+
+def test_large_image_is_downscaled_to_jpeg():
+    data, mime_type, _ = preprocess_image(meme("büyük"), 256, 85)
+    assert mime_type == "image/jpeg"
+    with Image.open(io.BytesIO(data)) as image:
+        assert max(image.size) <= 256
+
+
+def test_prepare_image_in_the_worker_pool():
+    data = meme("havuz")
+
+    async def scenario():
+        try:
+            return await bot.prepare_image(data)
+        finally:
+            bot.shutdown_image_pool()
+
+    processed, mime_type, content_hash = asyncio.run(scenario())
+    assert mime_type == "image/jpeg"
+    assert content_hash == hashlib.sha256(data).hexdigest()
+
+
+def stuck_preprocess(*args):
+    time.sleep(2)
+
+
+def test_stuck_worker_falls_back_to_the_original(monkeypatch):
+    data = meme("takıldı")
+    monkeypatch.setattr(bot, "IMAGE_PREPROCESS_TIMEOUT", 0.2)
+    monkeypatch.setattr(bot, "preprocess_image", stuck_preprocess)
+
+    async def scenario():
+        pool = bot.get_image_pool()
+        try:
+            task = asyncio.ensure_future(bot.prepare_image(data))
+            await asyncio.sleep(0.1)
+            workers = list(pool._processes.values())
+            return await task, workers, bot._image_pool is not pool
+        finally:
+            bot.shutdown_image_pool()
+
+    started = time.monotonic()
+    (processed, _, content_hash), workers, recycled = asyncio.run(scenario())
+    assert time.monotonic() - started < 1.5
+    assert processed == data
+    assert content_hash == hashlib.sha256(data).hexdigest()
+    # The timeout recycled the pool and killed the stuck worker instead of leaving it running
+    assert recycled
+    for process in workers:
+        process.join(1)
+        assert not process.is_alive()
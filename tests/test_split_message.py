@@ -0,0 +1,119 @@
+import random
+import re
+
+import pytest
+
+from bot import split_message
+
+WORDS = ["Nyxie", "protogen", "vizör", "merhaba", "dünya", "kod", "a", "abcdefghijklmnopqrstuvwxyz" * 3]
+PIECES = [
+    lambda rng: " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 40))),
+    lambda rng: "\n",
+    lambda rng: "\n\n",
+    lambda rng: ". ",
+    lambda rng: "`" + rng.choice(WORDS) + "`",
+    lambda rng: "**" + " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6))) + "**",
+    lambda rng: "[" + rng.choice(WORDS) + "](https://example.com/" + rng.choice(WORDS) + ")",
+    lambda rng: "```\n" + "\n".join("x = " + rng.choice(WORDS) * rng.randint(1, 5) for _ in range(rng.randint(1, 60))) + "\n```",
+    lambda rng: "```" + " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 200))) + "```",
+    lambda rng: "```",
+    lambda rng: "x" * rng.randint(1, 300),
+]
+
+
+def random_text(rng):
+    return "".join(rng.choice(PIECES)(rng) for _ in range(rng.randint(0, 60)))
+
+
+def visible(text):
+    """Text without whitespace and backticks, which the splitter may add or drop at chunk edges"""
+    return re.sub(r"[\s`]", "", text)
+
+
+def is_subsequence(needle, haystack):
+    remaining = iter(haystack)
+    return all(char in remaining for char in needle)
+
+
+def test_short_text_is_one_chunk():
+    assert split_message("Merhaba!") == ["Merhaba!"]
+
+
+def test_empty_and_blank_text():
+    assert split_message("") == []
+    assert split_message(" \n\n ") == []
+
+
+def test_blank_lines_are_kept():
+    assert split_message("bir\n\niki") == ["bir\n\niki"]
+
+
+def test_splits_at_paragraph_break():
+    text = "a" * 60 + "\n\n" + "b" * 60
+    assert split_message(text, 100) == ["a" * 60, "b" * 60]
+
+
+def test_does_not_cut_inside_inline_markdown():
+    text = "word " * 15 + "**kalın bir ifade** ve [bağlantı](https://example.com) " + "son " * 20
+    for chunk in split_message(text, 80):
+        assert chunk.count("**") % 2 == 0
+        assert chunk.count("[") == chunk.count("](")
+
+
+def test_long_code_block_is_reopened_with_its_language():
+    text = "```python\n" + "print('merhaba')\n" * 100 + "```"
+    chunks = split_message(text, 200)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(chunk) <= 200
+        assert chunk.startswith("```python\n")
+        assert chunk.endswith("```")
+
+
+def test_long_single_line_code_opener_does_not_hang():
+    text = "Result: ```" + "ab " * 1500 + "```\nThanks!"
+    chunks = split_message(text, 4096)
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    assert visible("".join(chunks)) == visible(text)
+
+
+def test_opener_longer_than_chunk_does_not_hang():
+    text = "```" + "y" * 500 + "\n" + "z\n" * 300 + "```"
+    chunks = split_message(text, 100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert visible("".join(chunks)) == visible(text)
+
+
+def test_unclosed_code_block():
+    text = "```\n" + "satır\n" * 200
+    chunks = split_message(text, 100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert visible("".join(chunks)) == visible(text)
+
+
+@pytest.mark.parametrize("max_length", [1, 2, 3, 4, 5, 8])
+def test_tiny_max_length(max_length):
+    text = "```python\nprint(1)\n```\n**kalın** `kod` kelime"
+    chunks = split_message(text, max_length)
+    assert all(len(chunk) <= max_length for chunk in chunks)
+    assert visible("".join(chunks)) == visible(text)
+
+
+def test_rejects_non_positive_max_length():
+    with pytest.raises(ValueError):
+        split_message("metin", 0)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_fuzz(seed):
+    rng = random.Random(seed)
+    text = random_text(rng)
+    max_length = rng.choice([1, 7, 16, 50, 100, 300, 4096])
+    chunks = split_message(text, max_length)
+    assert all(len(chunk) <= max_length for chunk in chunks)
+    assert all(chunk.strip() for chunk in chunks)
+    # Only fence lines are ever added, so the original text survives in order
+    if "```" in text:
+        assert is_subsequence(visible(text), visible("".join(chunks)))
+    else:
+        assert visible("".join(chunks)) == visible(text)
@@ -0,0 +1,13 @@
+import re
+
+import bot
+
+
+def test_import_stays_within_startup_budget(capsys):
+    # Imports bot.py in a fresh interpreter under -X importtime, as --profile-startup does
+    exit_code = bot.profile_startup()
+    output = capsys.readouterr().out
+    match = re.search(r"import bot: ([\d.]+)s .*budget ([\d.]+)s", output)
+    assert match, output
+    assert float(match.group(1)) <= float(match.group(2))
+    assert exit_code == 0
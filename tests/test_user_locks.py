@@ -0,0 +1,80 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+from bot import JsonMemoryStorage, MessageCoalescer, UserMemory, WordTokenCounter, serialize_per_user
+
+USERS = 5
+MESSAGES_PER_USER = 20
+
+
+def make_update(user_id, text):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=SimpleNamespace(text=text))
+
+
+def test_concurrent_updates_keep_each_users_history_in_order(tmp_path):
+    rng = random.Random(13)
+    running = {"now": 0, "max": 0}
+
+    async def scenario():
+        memory = UserMemory(storage=JsonMemoryStorage(str(tmp_path)), token_counter=WordTokenCounter())
+
+        @serialize_per_user
+        async def handler(update, context):
+            user_id = str(update.effective_user.id)
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            memory.add_message(user_id, "user", update.message.text)
+            # Stands in for the Gemini call between reading the history and saving the reply
+            await asyncio.sleep(rng.uniform(0, 0.005))
+            memory.add_message(user_id, "model", f"yanıt: {update.message.text}")
+            running["now"] -= 1
+
+        async def flusher():
+            while True:
+                await memory.flush()
+                await asyncio.sleep(0.002)
+
+        flush_task = asyncio.create_task(flusher())
+        # Updates arrive interleaved across users, in order per user
+        tasks = [
+            asyncio.create_task(handler(make_update(user_id, f"{user_id}-{i}"), None))
+            for i in range(MESSAGES_PER_USER) for user_id in range(USERS)
+        ]
+        await asyncio.gather(*tasks)
+        flush_task.cancel()
+        await memory.flush()
+
+    asyncio.run(scenario())
+    # Different users were handled at the same time
+    assert running["max"] > 1
+
+    reloaded = UserMemory(storage=JsonMemoryStorage(str(tmp_path)), token_counter=WordTokenCounter())
+    for user_id in range(USERS):
+        contents = [msg["content"] for msg in reloaded.get_user(str(user_id))["messages"]]
+        expected = []
+        for i in range(MESSAGES_PER_USER):
+            expected += [f"{user_id}-{i}", f"yanıt: {user_id}-{i}"]
+        assert contents == expected
+
+
+def test_photo_after_a_text_burst_is_answered_after_it():
+    handled = []
+
+    async def scenario():
+        async def text_handler(update, context, message_text):
+            handled.append(message_text)
+
+        @serialize_per_user
+        async def photo_handler(update, context):
+            handled.append(update.message.text)
+
+        coalescer = MessageCoalescer(text_handler, window=0.05)
+        burst = [asyncio.create_task(coalescer.submit(make_update(1, text), None)) for text in ("bir", "iki")]
+        await asyncio.sleep(0)
+        # Sent right after the burst, while its window is still open
+        photo = asyncio.create_task(photo_handler(make_update(1, "fotoğraf"), None))
+        await asyncio.gather(*burst, photo)
+
+    asyncio.run(scenario())
+    assert handled == ["bir\niki", "fotoğraf"]
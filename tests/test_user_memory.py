@@ -0,0 +1,359 @@
+import asyncio
+import threading
+
+import pytest
+
+from bot import HistoryCompactor, JsonMemoryStorage, SQLiteMemoryStorage, UserMemory, WordTokenCounter, metrics
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def make_storage(request, tmp_path):
+    if request.param == "json":
+        return lambda: JsonMemoryStorage(str(tmp_path / "user_memories"))
+    return lambda: SQLiteMemoryStorage(str(tmp_path / "user_memories.db"))
+
+
+def make_memory(storage):
+    return UserMemory(storage=storage, token_counter=WordTokenCounter())
+
+
+def test_folded_messages_stay_folded_after_reload(make_storage):
+    async def scenario():
+        memory = make_memory(make_storage())
+        for i in range(10):
+            memory.add_message("42", "user" if i % 2 == 0 else "model", f"mesaj {i}")
+        await memory.flush()
+        folded = list(memory.get_user("42")["messages"])[:6]
+        memory.apply_summary("42", "kısa özet", folded)
+        # The log is far shorter than the compaction slack, the rewrite must happen anyway
+        await memory.flush()
+        memory.storage.close()
+
+        reloaded = make_memory(make_storage())
+        record = reloaded.get_user("42")
+        assert record["summary"] == "kısa özet"
+        assert [msg["content"] for msg in record["messages"]] == [f"mesaj {i}" for i in range(6, 10)]
+        reloaded.storage.close()
+
+    asyncio.run(scenario())
+
+
+class CountingStorage:
+    """Wraps a storage backend and records every write_batch call"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.batches = []
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def write_batch(self, settings, appends, rewrites):
+        self.batches.append((set(settings), set(appends), set(rewrites)))
+        return self.storage.write_batch(settings, appends, rewrites)
+
+
+def test_eviction_hands_changes_to_the_flusher(make_storage):
+    async def scenario():
+        storage = CountingStorage(make_storage())
+        memory = make_memory(storage)
+        memory.users.max_users = 1
+        memory.add_message("1", "user", "birinci kullanıcı")
+        memory.add_message("2", "user", "ikinci kullanıcı")
+        # User 1 was evicted, but nothing is written from the event loop
+        assert "1" not in memory.users
+        assert storage.batches == []
+        await memory.flush()
+        assert any("1" in appends for _, appends, _ in storage.batches)
+        assert memory.evicted == {}
+        memory.storage.close()
+
+        reloaded = make_memory(make_storage())
+        assert [msg["content"] for msg in reloaded.get_user("1")["messages"]] == ["birinci kullanıcı"]
+        reloaded.storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_reload_before_flush_keeps_unsaved_messages(make_storage):
+    async def scenario():
+        memory = make_memory(make_storage())
+        memory.users.max_users = 1
+        memory.add_message("1", "user", "bir")
+        memory.add_message("2", "user", "iki")
+        memory.add_message("1", "user", "üç")
+        assert [msg["content"] for msg in memory.get_user("1")["messages"]] == ["bir", "üç"]
+        await memory.flush()
+        memory.storage.close()
+
+        reloaded = make_memory(make_storage())
+        assert [msg["content"] for msg in reloaded.get_user("1")["messages"]] == ["bir", "üç"]
+        assert [msg["content"] for msg in reloaded.get_user("2")["messages"]] == ["iki"]
+        reloaded.storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_history_keeps_insertion_order(tmp_path):
+    storage = SQLiteMemoryStorage(str(tmp_path / "user_memories.db"))
+    # Naive local timestamps go backwards when DST ends; some old records have none
+    messages = [
+        {"role": "user", "content": "önce", "timestamp": "2026-10-25T02:50:00", "tokens": 1},
+        {"role": "model", "content": "sonra", "timestamp": "2026-10-25T02:10:00", "tokens": 1},
+        {"role": "user", "content": "en son", "tokens": 1}
+    ]
+    storage.write_batch({"7": {"language": "tr"}}, {"7": messages}, {})
+    _, loaded = storage.load_user("7")
+    assert [msg["content"] for msg in loaded] == ["önce", "sonra", "en son"]
+    storage.close()
+
+
+def test_sqlite_load_does_not_wait_for_a_flush(tmp_path):
+    async def scenario():
+        storage = SQLiteMemoryStorage(str(tmp_path / "user_memories.db"))
+        memory = make_memory(storage)
+        memory.add_message("1", "user", "merhaba")
+        await memory.flush()
+        reader = make_memory(storage)
+        # A flush holding the writer lock must not stall a load
+        with storage._lock:
+            await asyncio.wait_for(reader.ensure_loaded("1"), 5)
+        assert [msg["content"] for msg in reader.get_user("1")["messages"]] == ["merhaba"]
+        storage.close()
+
+    asyncio.run(scenario())
+
+
+class GatedStorage(CountingStorage):
+    """Blocks the first write_batch until released, optionally failing it"""
+
+    def __init__(self, storage, fail_first=False):
+        super().__init__(storage)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.fail_first = fail_first
+
+    def write_batch(self, settings, appends, rewrites):
+        if not self.batches:
+            self.batches.append((set(settings), set(appends), set(rewrites)))
+            self.started.set()
+            self.release.wait(5)
+            if self.fail_first:
+                return 0, 0, set(settings) | set(appends) | set(rewrites)
+            return self.storage.write_batch(settings, appends, rewrites)
+        return super().write_batch(settings, appends, rewrites)
+
+
+@pytest.mark.parametrize("fail_first", [False, True])
+def test_user_evicted_and_reloaded_during_a_flush(make_storage, fail_first):
+    async def scenario():
+        storage = GatedStorage(make_storage(), fail_first)
+        memory = make_memory(storage)
+        memory.users.max_users = 1
+        memory.add_message("1", "user", "birinci")
+        flush = asyncio.create_task(memory.flush())
+        await asyncio.to_thread(storage.started.wait, 5)
+        # Evict user 1 while its message is being written, then bring it back
+        memory.add_message("2", "user", "başka")
+        await memory.ensure_loaded("1")
+        memory.add_message("1", "model", "ikinci")
+        storage.release.set()
+        await flush
+        await memory.flush()
+        await memory.flush()
+        memory.storage.close()
+
+        reloaded = make_memory(make_storage())
+        assert [msg["content"] for msg in reloaded.get_user("1")["messages"]] == ["birinci", "ikinci"]
+        assert [msg["content"] for msg in reloaded.get_user("2")["messages"]] == ["başka"]
+        reloaded.storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_cache_miss_reads_only_the_tail(make_storage):
+    async def scenario():
+        memory = make_memory(make_storage())
+        for i in range(50):
+            memory.add_message("1", "user", f"mesaj {i}")
+        await memory.flush()
+        memory.storage.close()
+
+        reloaded = make_memory(make_storage())
+        reloaded.load_tail_tokens = 10
+        reloaded.compact_slack = 0
+        await reloaded.ensure_loaded("1")
+        assert [msg["content"] for msg in reloaded.get_user("1")["messages"]] == [f"mesaj {i}" for i in range(45, 50)]
+        reloaded.add_message("1", "model", "yanıt")
+        # A tail record must never rewrite the log, even when it is far past the slack
+        await reloaded.flush(compact=True)
+        reloaded.users.max_users = 1
+        reloaded.add_message("2", "user", "başka")
+        await reloaded.flush(compact=True)
+        reloaded.storage.close()
+
+        full = make_memory(make_storage())
+        full.load_tail_tokens = 0
+        contents = [msg["content"] for msg in full.get_user("1")["messages"]]
+        assert contents == [f"mesaj {i}" for i in range(50)] + ["yanıt"]
+        full.storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_full_history_includes_unsaved_messages(make_storage):
+    async def scenario():
+        memory = make_memory(make_storage())
+        for i in range(20):
+            memory.add_message("1", "user", f"mesaj {i}")
+        await memory.flush()
+        memory.storage.close()
+
+        reloaded = make_memory(make_storage())
+        reloaded.load_tail_tokens = 4
+        await reloaded.ensure_loaded("1")
+        reloaded.add_message("1", "model", "kaydedilmedi")
+        assert await reloaded.load_full_history("1")
+        record = reloaded.get_user("1")
+        assert [msg["content"] for msg in record["messages"]] == [f"mesaj {i}" for i in range(20)] + ["kaydedilmedi"]
+        assert record["total_tokens"] == sum(msg["tokens"] for msg in record["messages"])
+        assert "_complete" not in record
+        await reloaded.flush()
+        reloaded.storage.close()
+
+        again = make_memory(make_storage())
+        again.load_tail_tokens = 0
+        assert len(again.get_user("1")["messages"]) == 21
+        again.storage.close()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 64, 65536])
+def test_json_log_tail_across_blocks(tmp_path, block_size):
+    storage = JsonMemoryStorage(str(tmp_path / "user_memories"))
+    messages = [{"role": "user", "content": f"mesaj {i}", "tokens": 2} for i in range(30)]
+    storage.write_log_file("1", messages)
+    assert storage.read_log_tail("1", 9, block_size) == (messages[-4:], False)
+    assert storage.read_log_tail("1", 60, block_size) == (messages, True)
+
+
+def test_flush_is_recorded_in_metrics(make_storage):
+    async def scenario():
+        memory = make_memory(make_storage())
+        before = metrics.counters.get(("nyxie_memory_flushes_total", ()), 0)
+        memory.add_message("1", "user", "merhaba")
+        await memory.flush()
+        memory.storage.close()
+        return before
+
+    before = asyncio.run(scenario())
+    assert metrics.counters[("nyxie_memory_flushes_total", ())] == before + 1
+    assert "# TYPE nyxie_memory_flush_seconds histogram" in metrics.render()
+
+
+class StubSummarizer:
+    """Async summarizer that records its calls; `during` runs while the call is awaited"""
+
+    def __init__(self, during=None):
+        self.calls = []
+        self.during = during
+
+    async def __call__(self, previous_summary, messages):
+        self.calls.append((previous_summary, [msg["content"] for msg in messages]))
+        await asyncio.sleep(0)
+        if self.during:
+            self.during()
+        return f"özet {len(self.calls)}"
+
+
+def fill_history(memory, user_id, count, start=0):
+    for i in range(start, start + count):
+        memory.add_message(user_id, "user", f"mesaj {i}")
+    # Activity times are set by hand so run_once can be driven with explicit clocks
+    memory.last_activity[user_id] = 0
+
+
+def make_compactor(memory, summarizer, **options):
+    # Each message is 2 tokens: the last 3 messages stay, 2 older ones are enough to fold
+    settings = {"keep_tokens": 6, "min_fold_tokens": 4, "idle_seconds": 100, "user_interval": 600, "max_per_minute": 10}
+    settings.update(options)
+    return HistoryCompactor(memory, summarizer, **settings)
+
+
+def contents(memory, user_id):
+    return [msg["content"] for msg in memory.get_user(user_id)["messages"]]
+
+
+def test_compactor_waits_for_idle_users(tmp_path):
+    async def scenario():
+        memory = make_memory(JsonMemoryStorage(str(tmp_path)))
+        summarizer = StubSummarizer()
+        compactor = make_compactor(memory, summarizer)
+        fill_history(memory, "1", 8)
+        assert await compactor.run_once(now=99) == 0
+        assert summarizer.calls == []
+        assert await compactor.run_once(now=100) == 1
+        assert summarizer.calls == [(None, [f"mesaj {i}" for i in range(5)])]
+        assert memory.get_user("1")["summary"] == "özet 1"
+        assert contents(memory, "1") == ["mesaj 5", "mesaj 6", "mesaj 7"]
+
+    asyncio.run(scenario())
+
+
+def test_compactor_honours_the_per_user_interval(tmp_path):
+    async def scenario():
+        memory = make_memory(JsonMemoryStorage(str(tmp_path)))
+        summarizer = StubSummarizer()
+        compactor = make_compactor(memory, summarizer)
+        fill_history(memory, "1", 8)
+        assert await compactor.run_once(now=100) == 1
+        fill_history(memory, "1", 5, start=8)
+        assert await compactor.run_once(now=699) == 0
+        assert await compactor.run_once(now=700) == 1
+        # The previous summary is handed to the next fold
+        assert summarizer.calls[1] == ("özet 1", [f"mesaj {i}" for i in range(5, 10)])
+
+    asyncio.run(scenario())
+
+
+def test_compactor_caps_summaries_per_minute(tmp_path):
+    async def scenario():
+        memory = make_memory(JsonMemoryStorage(str(tmp_path)))
+        summarizer = StubSummarizer()
+        compactor = make_compactor(memory, summarizer, max_per_minute=2)
+        for user_id in ("1", "2", "3", "4", "5"):
+            fill_history(memory, user_id, 8)
+        assert await compactor.run_once(now=1000) == 2
+        assert await compactor.run_once(now=1059) == 0
+        assert await compactor.run_once(now=1060) == 2
+        assert await compactor.run_once(now=1120) == 1
+        assert len(summarizer.calls) == 5
+
+    asyncio.run(scenario())
+
+
+def test_compactor_keeps_messages_changed_during_the_summary(tmp_path):
+    async def scenario():
+        memory = make_memory(JsonMemoryStorage(str(tmp_path)))
+
+        def trim_and_reply():
+            # The oldest folded messages are trimmed and a new message arrives meanwhile
+            memory.drop_oldest_message("1")
+            memory.drop_oldest_message("1")
+            memory.add_message("1", "model", "yeni")
+
+        compactor = make_compactor(memory, StubSummarizer(trim_and_reply))
+        fill_history(memory, "1", 8)
+        assert await compactor.run_once(now=100) == 1
+        record = memory.get_user("1")
+        assert contents(memory, "1") == ["mesaj 5", "mesaj 6", "mesaj 7", "yeni"]
+        assert record["total_tokens"] == sum(msg["tokens"] for msg in record["messages"])
+        await memory.flush()
+        memory.storage.close()
+
+        reloaded = make_memory(JsonMemoryStorage(str(tmp_path)))
+        assert reloaded.get_user("1")["summary"] == "özet 1"
+        assert contents(reloaded, "1") == ["mesaj 5", "mesaj 6", "mesaj 7", "yeni"]
+
+    asyncio.run(scenario())
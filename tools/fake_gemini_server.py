@@ -0,0 +1,140 @@
+"""Local stand-in for the Gemini REST API that injects latency and errors.
+
+Point the bot at it to exercise the retry, circuit breaker and hedging layer:
+
+    python tools/fake_gemini_server.py --port 8089 --latency 2 --jitter 1 --error-rate 0.3
+    GEMINI_TRANSPORT=rest GEMINI_API_ENDPOINT=http://127.0.0.1:8089 python bot.py
+
+It answers `models/*:generateContent` and `models/*:streamGenerateContent`
+(both JSON array and `alt=sse` streaming) with a canned reply.
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ERROR_STATUS = {
+    429: "RESOURCE_EXHAUSTED",
+    500: "INTERNAL",
+    503: "UNAVAILABLE",
+    504: "DEADLINE_EXCEEDED"
+}
+
+
+def make_response(text):
+    return {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": text}]},
+            "finishReason": "STOP",
+            "index": 0
+        }],
+        "usageMetadata": {
+            "promptTokenCount": 1,
+            "candidatesTokenCount": len(text.split()),
+            "totalTokenCount": 1 + len(text.split())
+        }
+    }
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    options = None
+    stats = {"requests": 0, "errors": 0}
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.stats["requests"] += 1
+
+        request_number = self.stats["requests"]
+
+        delay = max(0.0, random.gauss(self.options.latency, self.options.jitter))
+        time.sleep(delay)
+
+        if request_number <= self.options.fail_first or random.random() < self.options.error_rate:
+            self.stats["errors"] += 1
+            code = random.choice(self.options.error_codes)
+            self.send_json(code, {"error": {
+                "code": code,
+                "message": "Injected failure from fake Gemini server",
+                "status": ERROR_STATUS.get(code, "UNKNOWN")
+            }})
+            return
+
+        path = self.path.split("?", 1)[0]
+        text = self.options.reply
+        if path.endswith(":generateContent"):
+            self.send_json(200, make_response(text))
+        elif path.endswith(":streamGenerateContent"):
+            words = text.split(" ")
+            chunks = [" ".join(words[i:i + 5]) + " " for i in range(0, len(words), 5)]
+            if "alt=sse" in self.path:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(f"data: {json.dumps(make_response(chunk))}\r\n\r\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(self.options.chunk_delay)
+            else:
+                self.send_json(200, [make_response(chunk) for chunk in chunks])
+        elif path.endswith(":countTokens"):
+            self.send_json(200, {"totalTokens": 1})
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"Unknown path {path}", "status": "NOT_FOUND"}})
+
+
+def create_server(options):
+    """HTTP server on (options.host, options.port) with its own handler options and counters"""
+    handler = type("Handler", (FakeGeminiHandler,), {"options": options, "stats": {"requests": 0, "errors": 0}})
+    return ThreadingHTTPServer((options.host, options.port), handler)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="standard deviation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--fail-first", type=int, default=0, help="fail this many requests before answering normally")
+    parser.add_argument(
+        "--error-codes",
+        type=lambda value: [int(code) for code in value.split(",")],
+        default=[429, 503],
+        help="comma separated HTTP statuses to inject"
+    )
+    parser.add_argument("--chunk-delay", type=float, default=0.1, help="delay between streamed chunks")
+    parser.add_argument("--reply", default="Merhaba! Ben Nyxie, sahte Gemini sunucusundan selamlar. " * 3)
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_args()
+    server = create_server(options)
+    stats = server.RequestHandlerClass.stats
+    print(f"Fake Gemini listening on http://{options.host}:{options.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Served {stats['requests']} requests, {stats['errors']} injected errors")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""POST recorded Telegram updates to the bot's webhook endpoint.
+
+Run the bot in webhook mode against this tool's stand-in Bot API, so nothing
+reaches Telegram and the replies are printed here instead:
+
+    python tools/post_update.py --serve-api 8081
+    TELEGRAM_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_SECRET_TOKEN=s3cret \
+        TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 python bot.py
+    python tools/post_update.py --secret s3cret --text "merhaba" --repeat 20
+    python tools/post_update.py --secret s3cret recorded_updates.jsonl
+
+Update files hold one update object, a JSON list of updates, or one update
+per line (JSONL).
+"""
+import argparse
+import itertools
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRUE_METHODS = {"setWebhook", "deleteWebhook", "sendChatAction", "setMyCommands", "close", "logOut"}
+MESSAGE_METHODS = {"sendMessage", "editMessageText"}
+
+
+def make_text_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": "Test", "language_code": "tr"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Test"},
+            "from": user,
+            "text": text
+        }
+    }
+
+
+def load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        content = f.read().strip()
+    if not content:
+        return []
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+
+def post_update(url, secret, update):
+    body = json.dumps(update).encode("utf-8")
+    request = urllib.request.Request(url, data=body, method="POST", headers={"Content-Type": "application/json"})
+    if secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError as e:
+        status = f"error: {e.reason}"
+    return status, time.perf_counter() - started
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """Answers the Bot API calls the bot makes and prints what it would have sent"""
+    message_ids = itertools.count(1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_params(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length).decode("utf-8", errors="replace")
+        content_type = self.headers.get("Content-Type", "")
+        if "json" in content_type:
+            return json.loads(raw or "{}")
+        if "x-www-form-urlencoded" in content_type:
+            return {key: values[-1] for key, values in urllib.parse.parse_qs(raw).items()}
+        return {}
+
+    def do_POST(self):
+        # Paths look like /bot<token>/<method>
+        method = self.path.rstrip("/").rsplit("/", 1)[-1]
+        params = self.read_params()
+        if method == "getMe":
+            self.send_json({"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Nyxie", "username": "nyxie_test_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False
+            }})
+        elif method in TRUE_METHODS:
+            if method == "setWebhook":
+                print(f"setWebhook {params.get('url')} allowed_updates={params.get('allowed_updates')}")
+            self.send_json({"ok": True, "result": True})
+        elif method in MESSAGE_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            message_id = int(params.get("message_id") or next(self.message_ids))
+            print(f"{method} chat={chat_id} message={message_id}: {params.get('text', '')[:200]!r}")
+            self.send_json({"ok": True, "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", "")
+            }})
+        else:
+            self.send_json({"ok": False, "error_code": 400, "description": f"{method} is not supported by the stand-in Bot API"})
+
+
+def serve_api(host, port):
+    server = ThreadingHTTPServer((host, port), FakeBotApiHandler)
+    print(f"Stand-in Bot API listening on http://{host}:{port}")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="*", help="recorded update files (JSON or JSONL)")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram", help="webhook endpoint")
+    parser.add_argument("--secret", default=None, help="value of WEBHOOK_SECRET_TOKEN")
+    parser.add_argument("--text", default=None, help="post a synthetic text message instead of files")
+    parser.add_argument("--users", type=int, default=1, help="number of distinct users for --text")
+    parser.add_argument("--repeat", type=int, default=1, help="post every update this many times")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--serve-api", type=int, metavar="PORT", help="run a stand-in Bot API on this port")
+    parser.add_argument("--host", default="127.0.0.1")
+    options = parser.parse_args()
+
+    if options.serve_api:
+        server = serve_api(options.host, options.serve_api)
+        if not options.files and options.text is None:
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                server.shutdown()
+                return
+
+    updates = []
+    for path in options.files:
+        updates.extend(load_updates(path))
+    if options.text is not None:
+        updates.extend(make_text_update(0, 1000 + user, options.text) for user in range(options.users))
+    # Give every posted update its own update_id, like Telegram does
+    base_id = int(time.time())
+    updates = [
+        dict(update, update_id=base_id + index)
+        for index, update in enumerate(u for u in updates for _ in range(options.repeat))
+    ]
+    if not updates:
+        parser.error("nothing to post: give update files or --text")
+
+    with ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+        results = list(pool.map(lambda update: post_update(options.url, options.secret, update), updates))
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = sorted(elapsed for _, elapsed in results)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"posted {len(results)} updates, statuses {statuses}")
+    print(f"latency p50 {statistics.median(latencies) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms")
+
+    if options.serve_api:
+        # Keep serving replies the bot sends after acknowledging the webhook
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()